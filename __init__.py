@@ -26,8 +26,8 @@ bl_info = {
 }
 
 
-from . import operators, ui, keymaps, prefs
-modules = (operators, ui, keymaps, prefs)
+from . import operators, ui, keymaps, prefs, render_cache, scene_state
+modules = (operators, ui, keymaps, prefs, render_cache, scene_state)
 
 
 def register():
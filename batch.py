@@ -0,0 +1,182 @@
+"""
+Headless batch export for Easy MC Passes.
+
+Exports the passes & masks of many .blend files without opening Blender's UI,
+running several background Blender instances at once:
+
+    blender -b --python /path/to/easy_mc_passes/batch.py -- [options] shot_010.blend shot_020.blend ...
+
+Options:
+    --jobs N              Number of Blender instances exporting at the same time (default: 1)
+    --scene NAME          Scene to export (default: the active scene of each file)
+    --set PROP=VALUE      Override a setting of the scene's Easy MC Passes properties,
+                          e.g. --set export_path=//passes/ --set mask_type=BLACK_AND_WHITE
+    --pref PROP=VALUE     Override an add-on preference, e.g. --pref view_passes_after_render=false
+    --passes NAME,...     Only export the listed passes (e.g. --passes Combined,Normal,Cavity)
+    --preview             Export with the reduced preview settings into the preview subfolder
+    --queue               Run the scene's export queue instead of a single export,
+                          skipping the jobs that already finished
+    --blender PATH        Blender executable used for the worker instances (default: the running one)
+
+The process exits with a non-zero code if any of the files fails to export.
+"""
+
+import bpy
+import addon_utils
+
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args(argv):
+    argv = argv[argv.index("--") + 1:] if "--" in argv else []
+
+    parser = argparse.ArgumentParser(prog="batch.py", description="Headless batch export for Easy MC Passes")
+    parser.add_argument("files", nargs="*", help=".blend files to export")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--scene", default="")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="PROP=VALUE")
+    parser.add_argument("--pref", dest="pref_overrides", action="append", default=[], metavar="PROP=VALUE")
+    parser.add_argument("--passes", default="")
+    parser.add_argument("--preview", action="store_true")
+    parser.add_argument("--queue", action="store_true")
+    parser.add_argument("--blender", default=bpy.app.binary_path)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+
+    return parser.parse_args(argv)
+
+
+def enable_addon():
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+
+    for module in addon_utils.modules():
+        if os.path.dirname(os.path.abspath(module.__file__)) == addon_dir:
+            module_name = module.__name__
+            break
+    else:
+        # Not installed as an add-on, so import it straight from its folder
+        sys.path.insert(0, os.path.dirname(addon_dir))
+        module_name = os.path.basename(addon_dir)
+
+    addon_utils.enable(module_name, default_set=True)
+    return sys.modules[module_name]
+
+
+def parse_value(current, value):
+    if isinstance(current, bool):
+        return value.strip().lower() in {"1", "true", "yes", "on"}
+    elif isinstance(current, int):
+        return int(value)
+    elif isinstance(current, float):
+        return float(value)
+    elif isinstance(current, str):
+        return value
+    else:
+        return tuple(type(i)(j) for i, j in zip(current, value.split(",")))
+
+
+def apply_overrides(data, overrides):
+    for override in overrides:
+        prop, _, value = override.partition("=")
+        prop = prop.strip()
+
+        if not hasattr(data, prop):
+            raise ValueError(f"Unknown property \"{prop}\"")
+
+        setattr(data, prop, parse_value(getattr(data, prop), value))
+
+
+def report(level, message):
+    print(message)
+
+
+def run_worker(args):
+    addon = enable_addon()
+
+    scene = bpy.data.scenes[args.scene] if args.scene else bpy.context.scene
+
+    with bpy.context.temp_override(scene=scene):
+        # The file was loaded before the add-on got enabled
+        addon.prefs.onFileLoaded(None)
+
+        props = scene.EMP_Properties
+        apply_overrides(props, args.overrides)
+        apply_overrides(addon.utils.fetch_user_preferences(), args.pref_overrides)
+
+        if args.passes:
+            enabled = set(i.strip() for i in args.passes.split(","))
+            for render_pass in props.render_passes:
+                render_pass.render = render_pass.name in enabled
+
+        if args.queue:
+            failed = addon.export_job.run_export_queue_headless(scene, report=report)
+            if failed > 0:
+                raise RuntimeError(f"{failed} export job(s) failed")
+            return
+
+        if not addon.operators.EMP_OT_EXPORT_PASSES.poll(bpy.context):
+            raise RuntimeError("Nothing to export: enable a pass or mask and use EEVEE or Cycles as the render engine")
+
+        profile = "PREVIEW" if args.preview else "FINAL"
+        addon.export_job.export_passes_headless(scene, report=report, profile=profile)
+
+
+def export_file(args, filepath):
+    command = [
+        args.blender, "--background", "--python-exit-code", "1", filepath,
+        "--python", os.path.abspath(__file__),
+        "--", "--worker",
+        ]
+
+    if args.scene:
+        command.append(f"--scene={args.scene}")
+    if args.passes:
+        command.append(f"--passes={args.passes}")
+    if args.preview:
+        command.append("--preview")
+    if args.queue:
+        command.append("--queue")
+
+    command.extend(f"--set={i}" for i in args.overrides)
+    command.extend(f"--pref={i}" for i in args.pref_overrides)
+
+    print(f"[Easy MC Passes] Exporting \"{filepath}\"")
+    result = subprocess.run(command)
+    return result.returncode
+
+
+def run_batch(args):
+    if not args.files:
+        print("[Easy MC Passes] No .blend files given", file=sys.stderr)
+        return 1
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        return_codes = tuple(executor.map(lambda filepath: export_file(args, filepath), args.files))
+
+    failed = tuple(filepath for filepath, code in zip(args.files, return_codes) if code != 0)
+    print(f"[Easy MC Passes] Exported {len(args.files) - len(failed)}/{len(args.files)} file(s)")
+
+    for filepath in failed:
+        print(f"[Easy MC Passes] Failed: \"{filepath}\"", file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+def main():
+    args = parse_args(sys.argv)
+
+    if args.worker:
+        try:
+            run_worker(args)
+        except Exception as error:
+            print(f"[Easy MC Passes] {type(error).__name__}: {error}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        sys.exit(run_batch(args))
+
+
+if __name__ == "__main__":
+    main()
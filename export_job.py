@@ -0,0 +1,683 @@
+import bpy
+
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from .image_derivation import derive_images, finish_image_derivation, start_image_derivation
+from .plan import apply_plan_graph, apply_plan_scenes, compile_export_plan, write_packed_mask_index
+from .render_cache import discard_stale_renders, render_pending_scenes, use_cached_renders
+from .workers import finish_parallel_renders, render_scenes_in_parallel, start_parallel_renders
+from .utils import (
+    blank_render_scene,
+    clear_helper_datablocks,
+    fetch_user_preferences,
+    get_multilayer_render_path,
+    get_render_result,
+    helper_pool_enabled,
+    load_image,
+    prepare_file_render,
+    restore_pass_indices,
+    )
+
+
+active_job = None
+active_queue = None
+# Per-frame render time of each helper scene role by source scene name, kept for the session only
+render_times = {}
+
+
+def prepare_export(scene, report=None, keep_helpers=False, profile="FINAL"):
+    prefs = fetch_user_preferences()
+
+    plan = compile_export_plan(scene, profile=profile)
+    is_animation = plan.frames is not None
+
+    # Scenes are rendered to files when they are cached or rendered in parallel,
+    # which only ever holds a single frame
+    use_file_renders = (prefs.use_render_cache or prefs.render_helpers_in_parallel) and not is_animation
+    pending = ()
+    if use_file_renders:
+        plan, pending = use_cached_renders(plan, scene, reuse=prefs.use_render_cache)
+
+        reused_count = len(plan.scenes) - len(pending)
+        if reused_count > 0 and report is not None:
+            report({'INFO'}, f"Reused {reused_count} cached render(s)")
+
+    if not (helper_pool_enabled() or keep_helpers):
+        clear_helper_datablocks(report=report)
+
+    if report is not None:
+        report_shading_strategy(scene, plan, report)
+        for warning in plan.warnings:
+            report({'WARNING'}, warning)
+
+    apply_plan_scenes(plan, scene)
+    return plan, pending, use_file_renders
+
+
+def report_shading_strategy(scene, plan, report):
+    strategy = plan.shading_strategy
+
+    if strategy == "LIGHTGROUPS":
+        message = "Shading & Shadow passes taken from lightgroups of the main render"
+        if saved_time := stored_render_times(scene).get("SHADING"):
+            message += f", saving about {format_duration(saved_time)} per frame"
+        report({'INFO'}, message)
+
+    elif strategy == "SCENE_COPY":
+        message = "Shading & Shadow passes rendered in a separate scene"
+        if scene.EMP_Properties.shading_strategy == "LIGHTGROUPS":
+            if scene.render.engine != 'CYCLES':
+                message += " (lightgroups need Cycles as the render engine)"
+            else:
+                message += " (lightgroups need denoising to be off, as they aren't denoised along with Combined)"
+        report({'INFO'}, message)
+
+
+def stored_render_times(scene):
+    return dict(render_times.get(scene.name, {}))
+
+
+def store_render_times(scene, plan, scene_times, frame_count=1):
+    # Per-frame render time of each helper scene role, used to estimate what other strategies save
+    roles = {i.name : i.role for i in plan.scenes}
+    scene_render_times = render_times.setdefault(scene.name, {})
+
+    for scene_name, seconds in scene_times.items():
+        if scene_name in roles:
+            scene_render_times[roles[scene_name]] = seconds / max(frame_count, 1)
+
+
+def finish_export_graph(plan, use_file_renders):
+    if use_file_renders:
+        blank_render_scene(bpy.data.scenes[plan.main_scene.name])
+
+    main_scene, _ = apply_plan_graph(plan)
+    write_packed_mask_index(plan)
+    return main_scene
+
+
+def export_passes_headless(scene, report=None, keep_helpers=False, profile="FINAL"):
+    # Same pipeline as the export operator, but without any screen or invoked render
+    prefs = fetch_user_preferences()
+    plan, pending, use_file_renders = prepare_export(scene, report=report, keep_helpers=keep_helpers, profile=profile)
+
+    if prefs.render_helpers_in_parallel:
+        render_scenes_in_parallel(pending, threads=prefs.worker_threads)
+    else:
+        store_render_times(scene, plan, render_pending_scenes(pending))
+
+    main_scene = finish_export_graph(plan, use_file_renders)
+    try:
+        bpy.ops.render.render(animation=(plan.frames is not None), scene=main_scene.name)
+    finally:
+        restore_pass_indices()
+
+    derive_images(plan)
+
+    if not (helper_pool_enabled() or keep_helpers):
+        clear_helper_datablocks(report=report)
+
+    if report is not None:
+        report({'INFO'}, f"Successfully exported files at \"{plan.output_path}\"")
+
+    return plan
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+@dataclass(slots=True)
+class ExportStep:
+    label: str
+    start: Callable
+    # Number of render layers the step renders, used to weigh the progress
+    weight: float = 1.0
+    # Steps that start an invoked render finish through the render handlers,
+    # the others finish as soon as poll() returns True
+    is_render: bool = False
+    poll: Callable = None
+    finish: Callable = None
+
+
+class ExportJob:
+    sample_pattern = re.compile(r"(?:Sample|Rendered) (\d+)\s*/\s*(\d+)")
+    frame_pattern = re.compile(r"Fra:\s*(-?\d+)")
+
+    def __init__(self, window, screen, scene, keep_helpers=False, profile="FINAL"):
+        self.window = window
+        self.screen = screen
+        self.scene_name = scene.name
+        self.prefs = fetch_user_preferences()
+        self.keep_helpers = keep_helpers
+        self.profile = profile
+
+        self.plan = None
+        self.scene_names = set()
+        self.workers = []
+        self.image_futures = []
+        self.steps = []
+        self.step_index = -1
+
+        self.start_time = time.monotonic()
+        self.status = "Preparing export"
+        self.render_layer = ""
+        self.render_fraction = 0.0
+        self.render_frame = None
+        self.finished_frames = 0
+        self.finished_layers = set()
+
+        self.step_start_time = None
+        self.render_scene = ""
+        self.layer_start_time = None
+        self.scene_times = {}
+
+        self.is_rendering = False
+        self.is_cancelled = False
+        self.is_finished = False
+        self.error = ""
+        self.messages = []
+
+    # Progress
+    @property
+    def total_weight(self):
+        return sum(i.weight for i in self.steps) or 1.0
+
+    @property
+    def progress(self):
+        if self.is_finished:
+            return 1.0
+        if self.step_index < 0:
+            return 0.0
+
+        done = sum(i.weight for i in self.steps[:self.step_index])
+        step = self.steps[self.step_index]
+
+        if step.is_render and step.weight > 0:
+            frame_count = 1 if self.plan.frames is None else len(self.plan.frames)
+            finished = self.finished_frames * step.weight / frame_count + len(self.finished_layers)
+            done += min(finished + self.render_fraction, step.weight)
+
+        return min(done / self.total_weight, 1.0)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    @property
+    def eta(self):
+        progress = self.progress
+        if progress <= 0.0:
+            return None
+
+        return self.elapsed * (1.0 - progress) / progress
+
+    @property
+    def summary(self):
+        eta = self.eta
+        eta = "--:--" if eta is None else format_duration(eta)
+        return f"Elapsed {format_duration(self.elapsed)}  |  ETA {eta}"
+
+    # Setup
+    def report(self, level, message):
+        self.messages.append(message)
+
+    def start(self):
+        global active_job
+        active_job = self
+
+        scene = bpy.data.scenes[self.scene_name]
+        self.plan, pending, use_file_renders = prepare_export(scene, report=self.report, keep_helpers=self.keep_helpers, profile=self.profile)
+
+        self.scene_names = set(i.name for i in self.plan.scenes)
+
+        if self.prefs.render_helpers_in_parallel and len(pending) > 0:
+            self.steps.append(ExportStep(
+                label=f"Rendering {len(pending)} helper scene(s) in background",
+                start=lambda: self.workers.extend(start_parallel_renders(pending, threads=self.prefs.worker_threads)),
+                weight=sum(self.layer_count(spec) for spec, _ in pending),
+                poll=lambda: all(process.poll() is not None for *_, process in self.workers),
+                finish=lambda: finish_parallel_renders(self.workers),
+                ))
+        else:
+            for spec, path in pending:
+                self.steps.append(ExportStep(
+                    label=f"Rendering {spec.name}",
+                    start=lambda spec=spec: self.invoke_render(bpy.data.scenes[spec.name], prepare=True),
+                    weight=self.layer_count(spec),
+                    is_render=True,
+                    finish=lambda spec=spec, path=path: self.save_render(spec, path),
+                    ))
+
+        self.steps.append(ExportStep(
+            label="Building compositor graph",
+            start=lambda: finish_export_graph(self.plan, use_file_renders),
+            weight=0.0,
+            poll=lambda: True,
+            ))
+
+        frame_count = 1 if self.plan.frames is None else len(self.plan.frames)
+        self.steps.append(ExportStep(
+            label="Rendering passes",
+            start=lambda: self.invoke_render(bpy.data.scenes[self.plan.main_scene.name], animation=self.plan.frames is not None),
+            weight=(1 if use_file_renders else self.plan.render_count // frame_count) * frame_count,
+            is_render=True,
+            finish=self.show_multilayer_image,
+            ))
+
+        if self.plan.derived_images:
+            self.steps.append(ExportStep(
+                label=f"Writing {len(self.plan.derived_images)} image(s) from EXR",
+                start=lambda: self.image_futures.extend(start_image_derivation(self.plan)),
+                poll=lambda: all(i.done() for i in self.image_futures),
+                finish=lambda: finish_image_derivation(self.image_futures),
+                ))
+
+        for handlers, handler in self.handlers:
+            handlers.append(handler)
+
+        bpy.app.timers.register(self.tick, first_interval=0.1)
+
+    @staticmethod
+    def layer_count(spec):
+        return sum(1 for i in spec.view_layers if i.use)
+
+    # Steps
+    def invoke_render(self, scene, animation=False, prepare=False):
+        if prepare:
+            prepare_file_render(scene)
+
+        self.is_rendering = True
+        self.render_fraction = 0.0
+        self.render_frame = None
+        self.finished_frames = 0
+        self.finished_layers.clear()
+
+        op_mode = 'INVOKE_SCREEN' if self.prefs.force_render_window else 'INVOKE_DEFAULT'
+        with bpy.context.temp_override(window=self.window):
+            result = bpy.ops.render.render(op_mode, animation=animation, scene=scene.name)
+
+        # e.g. when another render is still running, in which case no render handler would ever end the step
+        if 'CANCELLED' in result:
+            self.is_rendering = False
+            raise RuntimeError(f"Could not start rendering \"{scene.name}\", another render may still be running")
+
+    def save_render(self, spec, path):
+        self.add_scene_time(spec.name, time.monotonic() - self.step_start_time)
+
+        get_render_result().save_render(path, scene=bpy.data.scenes[spec.name])
+        discard_stale_renders(spec.name, path)
+
+    def add_scene_time(self, scene_name, seconds):
+        self.scene_times[scene_name] = self.scene_times.get(scene_name, 0.0) + seconds
+
+    def show_multilayer_image(self):
+        if not self.prefs.view_passes_after_render:
+            return
+
+        frame = None if self.plan.frames is None else self.plan.frames[-1]
+        img = load_image(name="EMP_Render Result", path=get_multilayer_render_path(frame=frame), replace_existing=True)
+
+        for area in self.screen.areas:
+            if area.type == 'IMAGE_EDITOR':
+                area.spaces.active.image = img
+
+    def tick(self):
+        try:
+            return self.advance()
+        except Exception as error:
+            self.error = f"{type(error).__name__}: {error}"
+            print(f"[Easy MC Passes] Export failed: {self.error}")
+            self.end(cleanup=True)
+            return None
+
+    def advance(self):
+        redraw_panels()
+
+        if self.is_cancelled and not self.is_rendering:
+            self.end(cleanup=True)
+            return None
+
+        if self.step_index >= 0:
+            step = self.steps[self.step_index]
+
+            if step.is_render:
+                if self.is_rendering:
+                    return 0.25
+            elif not step.poll():
+                return 0.25
+
+            if step.finish is not None:
+                step.finish()
+
+        self.step_index += 1
+        if self.step_index >= len(self.steps):
+            self.is_finished = True
+
+            frame_count = 1 if self.plan.frames is None else len(self.plan.frames)
+            store_render_times(bpy.data.scenes[self.scene_name], self.plan, self.scene_times, frame_count=frame_count)
+            self.end(cleanup=not (helper_pool_enabled() or self.keep_helpers))
+            return None
+
+        step = self.steps[self.step_index]
+        self.status = step.label
+        self.step_start_time = time.monotonic()
+        step.start()
+        return 0.25
+
+    def cancel(self):
+        self.is_cancelled = True
+        self.status = "Cancelling"
+
+        # Background instances can be stopped right away,
+        # while an invoked render stops the job once it completes (or is aborted with Esc)
+        for *_, process in self.workers:
+            if process.poll() is None:
+                process.terminate()
+
+    def end(self, cleanup):
+        global active_job
+
+        for handlers, handler in self.handlers:
+            if handler in handlers:
+                handlers.remove(handler)
+
+        restore_pass_indices()
+
+        if cleanup or self.is_cancelled:
+            clear_helper_datablocks(report=self.report)
+
+        if active_job is self:
+            active_job = None
+
+        redraw_panels()
+
+    # Render handlers
+    @property
+    def handlers(self):
+        handlers = bpy.app.handlers
+        return (
+            (handlers.render_stats, self.on_render_stats),
+            (handlers.render_complete, self.on_render_complete),
+            (handlers.render_cancel, self.on_render_cancel),
+            )
+
+    def on_render_stats(self, stats):
+        if match := self.frame_pattern.search(stats):
+            frame = int(match.group(1))
+            if frame != self.render_frame:
+                if self.render_frame is not None:
+                    self.finished_frames += 1
+                    self.finished_layers.clear()
+                    self.render_layer = ""
+                self.render_frame = frame
+
+        for part in stats.split(" | "):
+            scene_name, _, layer_name = part.partition(", ")
+            if layer_name and scene_name.strip() in self.scene_names:
+                layer = f"{scene_name.strip()} / {layer_name.strip()}"
+                if layer != self.render_layer:
+                    if self.render_layer:
+                        self.finished_layers.add(self.render_layer)
+                    self.finish_layer_time()
+                    self.render_layer = layer
+                    self.render_scene = scene_name.strip()
+                    self.render_fraction = 0.0
+
+        if match := self.sample_pattern.search(stats):
+            current, total = map(int, match.groups())
+            self.render_fraction = current / max(total, 1)
+
+    def finish_layer_time(self):
+        now = time.monotonic()
+        if self.render_scene and self.layer_start_time is not None:
+            self.add_scene_time(self.render_scene, now - self.layer_start_time)
+
+        self.layer_start_time = now
+
+    def on_render_complete(self, *args):
+        self.finish_layer_time()
+        self.is_rendering = False
+        self.render_layer = ""
+        self.render_scene = ""
+
+    def on_render_cancel(self, *args):
+        self.is_rendering = False
+        self.is_cancelled = True
+
+
+def queue_snapshot(scene):
+    props = scene.EMP_Properties
+    return (
+        scene.camera,
+        props.export_path,
+        {i.name : i.render for i in props.render_passes},
+        {i.name : i.render for i in props.mask_layers},
+        )
+
+
+def restore_queue_snapshot(scene, snapshot):
+    camera, export_path, passes, masks = snapshot
+    props = scene.EMP_Properties
+
+    scene.camera = camera
+    props.export_path = export_path
+    for i in props.render_passes:
+        i.render = passes.get(i.name, i.render)
+    for i in props.mask_layers:
+        i.render = masks.get(i.name, i.render)
+
+
+def queue_progress_path():
+    return bpy.data.filepath + ".emp_queue.json"
+
+
+def save_queue_progress(scene):
+    # Written next to the .blend rather than saving it,
+    # which would also store the helper scenes & the settings of the job that is running
+    if not (scene.EMP_Properties.save_queue_progress and bpy.data.is_saved):
+        return
+
+    path = queue_progress_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        progress = {}
+
+    progress[scene.name] = [(job.name, job.status, job.message) for job in scene.EMP_Properties.export_jobs]
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(progress, f, indent=4)
+
+
+def load_queue_progress():
+    # Progress saved after the .blend itself is newer than the job states stored in it
+    if not bpy.data.is_saved:
+        return
+
+    path = queue_progress_path()
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(bpy.data.filepath):
+        return
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    for scene_name, jobs in progress.items():
+        scene = bpy.data.scenes.get(scene_name)
+        if scene is None:
+            continue
+
+        for job, (name, status, message) in zip(scene.EMP_Properties.export_jobs, jobs):
+            if job.name == name:
+                job.status = status
+                job.message = message
+
+
+def queued_jobs(scene):
+    # Jobs left running by an interrupted session are picked up again
+    for index, job in enumerate(scene.EMP_Properties.export_jobs):
+        if job.status in {"QUEUED", "RUNNING"}:
+            yield index, job
+
+
+def run_export_queue_headless(scene, report=None):
+    snapshot = queue_snapshot(scene)
+    failed = 0
+
+    try:
+        for _, job in tuple(queued_jobs(scene)):
+            job.apply(scene)
+            job.status = "RUNNING"
+
+            try:
+                export_passes_headless(scene, report=report, keep_helpers=True)
+            except Exception as error:
+                job.status = "FAILED"
+                job.message = f"{type(error).__name__}: {error}"
+                failed += 1
+            else:
+                job.status = "DONE"
+                job.message = ""
+
+            save_queue_progress(scene)
+    finally:
+        restore_queue_snapshot(scene, snapshot)
+        if not helper_pool_enabled():
+            clear_helper_datablocks(report=report)
+
+    return failed
+
+
+class ExportQueue:
+    def __init__(self, window, screen, scene):
+        self.window = window
+        self.screen = screen
+        self.scene_name = scene.name
+
+        self.job = None
+        self.job_index = -1
+        self.job_count = 0
+        self.finished_count = 0
+        self.failed_count = 0
+        self.snapshot = None
+
+        self.is_cancelled = False
+        self.messages = []
+
+    @property
+    def scene(self):
+        return bpy.data.scenes[self.scene_name]
+
+    @property
+    def status(self):
+        job_name = self.scene.EMP_Properties.export_jobs[self.job_index].name if self.job_index >= 0 else ""
+        return f"Job {self.finished_count + 1}/{self.job_count}: {job_name}"
+
+    def start(self):
+        global active_queue
+        active_queue = self
+
+        self.snapshot = queue_snapshot(self.scene)
+        self.job_count = len(tuple(queued_jobs(self.scene)))
+        bpy.app.timers.register(self.tick, first_interval=0.1)
+
+    def tick(self):
+        try:
+            return self.advance()
+        except Exception as error:
+            message = f"{type(error).__name__}: {error}"
+            print(f"[Easy MC Passes] Export queue failed: {message}")
+            self.messages.append(f"Export queue failed: {message}")
+            self.failed_count += 1
+
+            if self.job is not None and active_job is self.job:
+                self.job.cancel()
+            self.end()
+            return None
+
+    def advance(self):
+        if self.job is not None:
+            if active_job is self.job:
+                return 0.5
+            self.finish_job()
+
+        queued = next(queued_jobs(self.scene), None)
+        if self.is_cancelled or queued is None:
+            self.end()
+            return None
+
+        self.start_job(*queued)
+        return 0.5
+
+    def start_job(self, index, job):
+        scene = self.scene
+        job.apply(scene)
+        job.status = "RUNNING"
+        self.job_index = index
+
+        # Helper scenes are kept between jobs, so that jobs sharing the same graph only re-render it
+        self.job = ExportJob(self.window, self.screen, scene, keep_helpers=True)
+        try:
+            self.job.start()
+        except Exception as error:
+            self.job.error = f"{type(error).__name__}: {error}"
+            self.job.end(cleanup=False)
+
+    def finish_job(self):
+        job, self.job = self.job, None
+        item = self.scene.EMP_Properties.export_jobs[self.job_index]
+
+        if job.error:
+            item.status = "FAILED"
+            item.message = job.error
+            self.failed_count += 1
+        elif job.is_cancelled:
+            # Left queued, so that the job runs again when the queue is resumed
+            item.status = "QUEUED"
+            self.is_cancelled = True
+            return
+        else:
+            item.status = "DONE"
+            item.message = ""
+
+        self.finished_count += 1
+        self.messages.extend(job.messages)
+        save_queue_progress(self.scene)
+
+    def report(self, level, message):
+        self.messages.append(message)
+
+    def cancel(self):
+        self.is_cancelled = True
+        if active_job is self.job and self.job is not None:
+            self.job.cancel()
+
+    def end(self):
+        global active_queue
+
+        restore_queue_snapshot(self.scene, self.snapshot)
+        if not helper_pool_enabled():
+            clear_helper_datablocks(report=self.report)
+
+        if active_queue is self:
+            active_queue = None
+
+        redraw_panels()
+
+
+def redraw_panels():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
@@ -0,0 +1,139 @@
+import bpy
+
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import get_multilayer_render_path
+
+
+channel_names = ("R", "G", "B", "A")
+# Channels a multilayer File Output writes for color, vector & float sockets,
+# and the channels of the derived image they fill in
+layer_channels = (
+    (("R", "G", "B", "A"), (0, 1, 2, 3)),
+    (("R", "G", "B"), (0, 1, 2)),
+    (("X", "Y", "Z"), (0, 1, 2)),
+    (("V",), (0, 0, 0)),
+    )
+
+
+def is_available():
+    return importlib.util.find_spec("OpenImageIO") is not None
+
+
+def ocio_config_path():
+    return bpy.utils.system_resource('DATAFILES', path=os.path.join("colormanagement", "config.ocio"))
+
+
+def display_settings(scene):
+    look = scene.view_settings.look
+    return (
+        scene.display_settings.display_device,
+        scene.view_settings.view_transform,
+        "" if look == "None" else look,
+        ocio_config_path(),
+        )
+
+
+def layer_indices(names, layer):
+    for channels, order in layer_channels:
+        if all(f"{layer}.{c}" in names for c in channels):
+            indices = tuple(names.index(f"{layer}.{c}") for c in channels)
+            return tuple(indices[i] for i in order)
+
+    return None
+
+
+def derive_image(exr_buf, names, layer, image_path, spec, display, view, look, config):
+    # Writes a single layer of the already read multilayer EXR the way the compositor's file slot would
+    from OpenImageIO import ImageBufAlgo
+
+    indices = layer_indices(names, layer)
+    if indices is None:
+        raise RuntimeError(f"The EXR has no layer \"{layer}\"")
+
+    # Layers without alpha are opaque
+    if len(indices) == 3:
+        indices = (*indices, 1.0)
+    buf = ImageBufAlgo.channels(exr_buf, indices, newchannelnames=channel_names)
+
+    # EXR slots stay scene linear, like in Blender
+    if spec.file_format == "PNG":
+        buf = ImageBufAlgo.ociodisplay(buf, display, view, fromspace="scene_linear", looks=look, unpremult=False, colorconfig=config)
+
+    channel_count = {"BW" : 1, "RGB" : 3, "RGBA" : 4}[spec.color_mode]
+    if buf.nchannels > channel_count:
+        buf = ImageBufAlgo.channels(buf, tuple(range(channel_count)))
+
+    if spec.file_format == "PNG":
+        buf.specmod().attribute("png:compressionLevel", round(spec.compression * 9 / 100))
+        data_format = "uint16" if spec.color_depth == "16" else "uint8"
+    else:
+        buf.specmod().attribute("compression", spec.exr_codec.lower())
+        data_format = "half" if spec.color_depth == "16" else "float"
+
+    if buf.has_error or not buf.write(image_path, data_format):
+        raise RuntimeError(buf.geterror())
+
+    return image_path
+
+
+def derive_frame_images(exr_path, images, settings):
+    # The EXR is read from disk once, and every image of the frame is made from it in memory
+    import OpenImageIO as oiio
+
+    exr_buf = oiio.ImageBuf(exr_path)
+    if not exr_buf.read(force=True):
+        raise RuntimeError(exr_buf.geterror())
+
+    names = tuple(exr_buf.spec().channelnames)
+
+    with ThreadPoolExecutor(max_workers=min(len(images), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(derive_image, exr_buf, names, spec.layer, image_path, spec, *settings) for spec, image_path in images]
+
+    return [future.result() for future in futures]
+
+
+def start_image_derivation(plan):
+    # The EXR paths & color settings are read here, since the worker threads can't touch bpy
+    if len(plan.derived_images) == 0:
+        return []
+
+    main_scene = bpy.data.scenes[plan.main_scene.name]
+    output_path = bpy.path.abspath(plan.output_path)
+    settings = display_settings(main_scene)
+    frames = (main_scene.frame_current,) if plan.frames is None else plan.frames
+
+    os.makedirs(output_path, exist_ok=True)
+
+    # Only a couple of frames are read at once, since each one is held in memory whole
+    executor = ThreadPoolExecutor(max_workers=min(len(frames), 2))
+    futures = []
+    for frame in frames:
+        exr_path = bpy.path.abspath(get_multilayer_render_path(frame=frame))
+
+        images = []
+        for spec in plan.derived_images:
+            extension = ".png" if spec.file_format == "PNG" else ".exr"
+            images.append((spec, os.path.join(output_path, f"{spec.name}{frame:04d}{extension}")))
+
+        futures.append(executor.submit(derive_frame_images, exr_path, images, settings))
+
+    executor.shutdown(wait=False)
+    return futures
+
+
+def finish_image_derivation(futures):
+    failed = []
+
+    for future in futures:
+        if error := future.exception():
+            failed.append(str(error))
+
+    if failed:
+        raise RuntimeError(f"Writing images of {len(failed)} frame(s) from the EXR failed: {failed[0]}")
+
+
+def derive_images(plan):
+    finish_image_derivation(start_image_derivation(plan))
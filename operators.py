@@ -4,33 +4,10 @@ from bpy.types import Operator
 import os
 from pathlib import Path
 
-from . import utils
-from .utils import (
-    add_node, 
-    create_matte_masks,
-    clear_helper_datablocks,
-    fetch_user_preferences,
-    get_addon_property,
-    get_mask_layers,
-    get_multilayer_render_path,
-    link_mask_sockets,
-    link_pass_sockets,
-    load_image,
-    create_scene, 
-    create_solo_view_layers,
-    create_file_outputs, 
-    create_file_masks,
-    create_exr_outputs,
-    init_main_passes_scene, 
-    init_cavity_scene, 
-    init_cryptomatte_scene,
-    init_shading_scene,
-    init_solo_scene
-    )
-
-
-render_screen = []
-multilayer_export_path = ""
+from . import export_job
+from .export_job import ExportJob, ExportQueue, export_passes_headless, queued_jobs, run_export_queue_headless
+from .plan import compile_export_plan
+from .utils import clear_helper_datablocks, get_addon_properties, get_addon_property
 
 
 class EMP_OT_EXPORT_PASSES(Operator):
@@ -39,6 +16,22 @@ class EMP_OT_EXPORT_PASSES(Operator):
     bl_description = "Render enabled passes & masks and export them as images"
     bl_options = {'REGISTER'} 
 
+    profile: bpy.props.EnumProperty(
+        name="Profile",
+        default="FINAL",
+        items=(
+            ("FINAL", "Final", "Render with the scene's own resolution and samples"),
+            ("PREVIEW", "Preview", "Render at a reduced resolution and sample count into the preview folder"),
+            ),
+        options={'SKIP_SAVE'}
+        )
+
+    @classmethod
+    def description(cls, context, props):
+        if props.profile == "PREVIEW":
+            return "Quickly render a low resolution, low sample preview of the enabled passes & masks"
+        return cls.bl_description
+
     @classmethod
     def poll(cls, context):
         outputs = (*get_addon_property("render_passes"), *get_addon_property("mask_layers"))
@@ -46,102 +39,237 @@ class EMP_OT_EXPORT_PASSES(Operator):
 
         is_engine_valid = context.scene.render.engine in {'BLENDER_EEVEE_NEXT', 'CYCLES'}
 
-        return any_passes_enabled and is_engine_valid
+        return any_passes_enabled and is_engine_valid and export_job.active_job is None and export_job.active_queue is None
+
+    def invoke(self, context, event):
+        if bpy.app.background:
+            return self.execute(context)
+
+        self.job = ExportJob(context.window, context.screen, context.scene, profile=self.profile)
+        try:
+            self.job.start()
+        except Exception as error:
+            self.job.end(cleanup=True)
+            self.report({'ERROR'}, f"Export failed: {error}")
+            return {'CANCELLED'}
+
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        job = self.job
+
+        if export_job.active_job is not job:
+            for message in job.messages:
+                self.report({'INFO'}, message)
+
+            if job.error:
+                self.report({'ERROR'}, f"Export failed: {job.error}")
+                return {'CANCELLED'}
+            elif job.is_cancelled:
+                self.report({'WARNING'}, "Export cancelled")
+                return {'CANCELLED'}
+            else:
+                self.report({'INFO'}, f"Successfully exported files at \"{job.plan.output_path}\"")
+                return {'FINISHED'}
+
+        if event.type == 'ESC' and event.value == 'PRESS':
+            job.cancel()
+
+        return {'PASS_THROUGH'}
+
+    def execute(self, context):
+        # Runs the whole export in one go, e.g. when called from a script
+        export_passes_headless(context.scene, report=self.report, profile=self.profile)
+        return {'FINISHED'}
+
+
+class EMP_OT_CANCEL_EXPORT(Operator):
+    bl_idname = "render.emp_cancel_export"
+    bl_label = "Cancel Export"
+    bl_description = "Stop the running export and remove its helper datablocks. (A render in progress finishes first unless it is stopped with Esc.)"
+    bl_options = {'REGISTER', 'INTERNAL'}
+
+    @classmethod
+    def poll(cls, context):
+        return export_job.active_job is not None or export_job.active_queue is not None
+
+    def execute(self, context):
+        if export_job.active_queue is not None:
+            export_job.active_queue.cancel()
+        elif export_job.active_job is not None:
+            export_job.active_job.cancel()
+
+        # Python can't abort a render that was invoked, only the user can
+        job = export_job.active_job
+        if job is not None and job.is_rendering:
+            self.report({'WARNING'}, "The export stops once the current render finishes, press Esc in the render window to stop it now")
+
+        return {'FINISHED'}
+
+
+class EMP_OT_RELEASE_HELPER_POOL(Operator):
+    bl_idname = "render.emp_release_helper_pool"
+    bl_label = "Release Helper Scenes"
+    bl_description = "Remove the helper scenes, lights and materials kept between exports"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return export_job.active_job is None and export_job.active_queue is None
+
+    def execute(self, context):
+        if clear_helper_datablocks(report=self.report) == 0:
+            self.report({'INFO'}, "No helper datablocks to release")
+        return {'FINISHED'}
+
+
+class EMP_OT_ADD_EXPORT_JOB(Operator):
+    bl_idname = "render.emp_add_export_job"
+    bl_label = "Add Export Job"
+    bl_description = "Add a job to the export queue with the current camera, export path, passes and masks"
+    bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        scene = context.scene
+        data = get_addon_properties()
+        job = data.export_jobs.add()
+        job.capture(context.scene)
 
-        export_path = get_addon_property("export_path")
-        prefs = fetch_user_preferences()
+        camera_name = context.scene.camera.name if context.scene.camera else "No Camera"
+        job.name = f"{camera_name} - {len(data.export_jobs):02d}"
+        data.active_export_job_index = len(data.export_jobs) - 1
+        return {'FINISHED'}
 
-        collection = get_addon_property("render_passes")
-        passes = tuple(utils.get_enabled_passes(collection))
-        masks = tuple(get_mask_layers())
 
-        names = tuple(i.name for i in passes)
-        main_passes = tuple(i.name for i in passes if i.name not in {"Shading", "Shadow", "Cavity"})
-        
-        clear_helper_datablocks()
+class EMP_OT_REMOVE_EXPORT_JOB(Operator):
+    bl_idname = "render.emp_remove_export_job"
+    bl_label = "Remove Export Job"
+    bl_description = "Remove the selected job from the export queue"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        main_scene = create_scene(scene, "EMP_Export_Passes", clear_tree=True)
-        init_main_passes_scene(main_scene, passes=main_passes)
+    @classmethod
+    def poll(cls, context):
+        return len(get_addon_property("export_jobs")) > 0 and export_job.active_queue is None
 
-        tree = main_scene.node_tree
-        output_node = add_node(tree, "CompositorNodeOutputFile", name="File Output (Images)", base_path=export_path, width=360, location=(500.0, 450.0))
-        output_node.file_slots.clear()
+    def execute(self, context):
+        data = get_addon_properties()
+        index = data.active_export_job_index
 
-        if prefs.view_passes_after_render:
-            exr_output_node = add_node(tree, "CompositorNodeOutputFile", name="File Output (EXR)", base_path=export_path + "Multilayer", width=360, location=(500.0, 160.0))
-            exr_output_node.format.file_format = "OPEN_EXR_MULTILAYER"
-            exr_output_node.file_slots.clear()
+        data.export_jobs.remove(index)
+        data.active_export_job_index = min(max(0, index - 1), len(data.export_jobs) - 1)
+        return {'FINISHED'}
 
-        main_passes_node = add_node(tree, "CompositorNodeRLayers", name="Main Passes", location=(0.0, 450.0))
-        main_passes_node.scene = main_scene
 
-        if ("Shading" in names) or ("Shadow" in names):
-            shading_scene = create_scene(scene, "EMP_Shading_and_Shadows", clear_tree=True)
-            init_shading_scene(shading_scene)
+class EMP_OT_UPDATE_EXPORT_JOB(Operator):
+    bl_idname = "render.emp_update_export_job"
+    bl_label = "Update Export Job"
+    bl_description = "Replace the selected job's settings with the current camera, export path, passes and masks"
+    bl_options = {'REGISTER', 'UNDO'}
 
-            shading_passes_node = add_node(tree, "CompositorNodeRLayers", name="Shading Passes", location=(0.0, 160.0))
-            shading_passes_node.scene = shading_scene
+    @classmethod
+    def poll(cls, context):
+        return len(get_addon_property("export_jobs")) > 0 and export_job.active_queue is None
 
-        if ("Cavity" in names):
-            cavity_scene = create_scene(scene, "EMP_Workbench_Cavity", clear_tree=True)
-            init_cavity_scene(cavity_scene)
+    def execute(self, context):
+        data = get_addon_properties()
+        try:
+            job = data.export_jobs[data.active_export_job_index]
+        except IndexError:
+            return {'CANCELLED'}
+
+        job.capture(context.scene)
+        job.status = "QUEUED"
+        job.message = ""
+        return {'FINISHED'}
 
-            cavity_pass_node = add_node(tree, "CompositorNodeRLayers", name="Cavity Pass", location=(0.0, -60.0))
-            cavity_pass_node.scene = cavity_scene
 
-        if len(masks) > 0:
-            cryptomatte_scene = create_scene(scene, "EMP_Cryptomatte", clear_tree=True)
-            init_cryptomatte_scene(cryptomatte_scene)
-            
-            solo_scene = create_scene(name="EMP_Solo_Masks", clear_tree=True)
-            init_solo_scene(solo_scene)
-            create_solo_view_layers(solo_scene)
+class EMP_OT_RESET_EXPORT_QUEUE(Operator):
+    bl_idname = "render.emp_reset_export_queue"
+    bl_label = "Reset Queue"
+    bl_description = "Mark every job of the export queue as queued again"
+    bl_options = {'REGISTER', 'UNDO'}
 
-            create_matte_masks(cryptomatte_scene, solo_scene, tree, masks, start_location=(-320.0, -400.0))
+    @classmethod
+    def poll(cls, context):
+        return len(get_addon_property("export_jobs")) > 0 and export_job.active_queue is None
 
-        create_file_outputs(output_node, passes)
-        create_file_masks(output_node, masks)
+    def execute(self, context):
+        for job in get_addon_property("export_jobs"):
+            job.status = "QUEUED"
+            job.message = ""
+        return {'FINISHED'}
 
-        if prefs.view_passes_after_render:
-            create_exr_outputs(exr_output_node, (*passes, *masks))
 
-        for render_pass in passes:
-            link_pass_sockets(tree, render_pass)
-        
-        for mask in masks:
-            link_mask_sockets(tree, mask)
+class EMP_OT_RUN_EXPORT_QUEUE(Operator):
+    bl_idname = "render.emp_run_export_queue"
+    bl_label = "Run Queue"
+    bl_description = "Export every queued job one after another. Finished jobs are skipped, so an interrupted queue continues where it stopped"
+    bl_options = {'REGISTER'}
 
-        if prefs.view_passes_after_render:
-            bpy.ops.render.render('INVOKE_SCREEN', scene=main_scene.name)
-            # context.scene disappears when invoked in the handler
-            # so temporarily store it in a list that can be called by the handler
-            render_screen.append(context.screen)
-            
-            global multilayer_export_path    
-            multilayer_export_path = get_multilayer_render_path()
+    @classmethod
+    def poll(cls, context):
+        is_idle = export_job.active_job is None and export_job.active_queue is None
+        is_engine_valid = context.scene.render.engine in {'BLENDER_EEVEE_NEXT', 'CYCLES'}
+        return is_idle and is_engine_valid and any(True for _ in queued_jobs(context.scene))
 
-            bpy.app.handlers.render_complete.append(load_multilayer_image)
-            return {'FINISHED'}
-        else:
-            op_mode = 'INVOKE_SCREEN' if prefs.force_render_window else 'EXEC_SCREEN'
-            bpy.ops.render.render(op_mode, scene=main_scene.name)
-            self.report({'INFO'}, f"Successfully exported files at \"{export_path}\"")
-            return {'FINISHED'}
+    def invoke(self, context, event):
+        if bpy.app.background:
+            return self.execute(context)
 
+        self.queue = ExportQueue(context.window, context.screen, context.scene)
+        self.queue.start()
 
-def load_multilayer_image(*args, **kwargs):
-    img = load_image(name="EMP_Render Result", path=multilayer_export_path, replace_existing=True)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
 
-    screen = render_screen.pop(0)
-    for area in screen.areas:
-        if area.type == 'IMAGE_EDITOR':
-            area.spaces.active.image = img
+    def modal(self, context, event):
+        queue = self.queue
 
-    bpy.app.handlers.render_complete.remove(load_multilayer_image)
-    bpy.app.timers.register(clear_helper_datablocks, first_interval=0.1)
+        if export_job.active_queue is not queue:
+            for message in queue.messages:
+                self.report({'INFO'}, message)
+
+            summary = f"{queue.finished_count - queue.failed_count}/{queue.job_count} job(s) exported"
+            if queue.failed_count > 0:
+                self.report({'ERROR'}, f"{summary}, {queue.failed_count} failed")
+                return {'CANCELLED'}
+            elif queue.is_cancelled:
+                self.report({'WARNING'}, f"Export queue cancelled, {summary}")
+                return {'CANCELLED'}
+            else:
+                self.report({'INFO'}, summary)
+                return {'FINISHED'}
+
+        if event.type == 'ESC' and event.value == 'PRESS':
+            queue.cancel()
+
+        return {'PASS_THROUGH'}
+
+    def execute(self, context):
+        failed = run_export_queue_headless(context.scene, report=self.report)
+        if failed > 0:
+            self.report({'ERROR'}, f"{failed} export job(s) failed")
+            return {'CANCELLED'}
+
+        return {'FINISHED'}
+
+
+class EMP_OT_PREVIEW_EXPORT_PLAN(Operator):
+    bl_idname = "render.emp_preview_export_plan"
+    bl_label = "Dry Run"
+    bl_description = "Print the export plan to the system console without rendering or creating any datablocks"
+    bl_options = {'REGISTER'}
+
+    @classmethod
+    def poll(cls, context):
+        return EMP_OT_EXPORT_PASSES.poll(context)
+
+    def execute(self, context):
+        plan = compile_export_plan(context.scene)
+        print(plan.describe())
+
+        self.report({'INFO'}, f"Export plan {plan.content_hash[:12]}: {plan.render_count} render(s), {len(plan.nodes)} node(s), {len(plan.slots)} file slot(s)")
+        return {'FINISHED'}
 
 
 class EMP_OT_OPEN_FILE_EXPLORER(Operator):
@@ -163,6 +291,14 @@ class EMP_OT_OPEN_FILE_EXPLORER(Operator):
 
 classes = (
     EMP_OT_EXPORT_PASSES,
+    EMP_OT_CANCEL_EXPORT,
+    EMP_OT_RELEASE_HELPER_POOL,
+    EMP_OT_ADD_EXPORT_JOB,
+    EMP_OT_REMOVE_EXPORT_JOB,
+    EMP_OT_UPDATE_EXPORT_JOB,
+    EMP_OT_RESET_EXPORT_QUEUE,
+    EMP_OT_RUN_EXPORT_QUEUE,
+    EMP_OT_PREVIEW_EXPORT_PLAN,
     EMP_OT_OPEN_FILE_EXPLORER,
 )
 
@@ -0,0 +1,1064 @@
+import bpy
+
+import hashlib
+import json
+import os
+from bpy_extras.object_utils import world_to_camera_view
+from mathutils import Euler, Vector
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from . import image_derivation
+from .selection import SelectionIndex, matte_selection
+from .utils import (
+    add_node,
+    apply_preview_settings,
+    assign_pass_indices,
+    begin_graph_build,
+    create_solo_view_layers,
+    data_passes,
+    ensure_file_slot,
+    ensure_scene,
+    fetch_user_preferences,
+    get_enabled_passes,
+    get_mask_layers,
+    helper_pool_enabled,
+    init_cavity_scene,
+    init_cryptomatte_scene,
+    init_main_passes_scene,
+    init_shading_scene,
+    init_solo_scene,
+    link_sockets,
+    load_multilayer_file,
+    pass_link_map,
+    prune_file_slots,
+    prune_graph,
+    prune_links,
+    remove_helper_scenes,
+    set_standard_view_settings,
+    restore_pass_indices,
+    shading_lightgroup_names,
+    )
+
+
+MAIN_SCENE_NAME = "EMP_Export_Passes"
+DATA_VIEW_LAYER_NAME = "EMP_DataPasses"
+SOLO_BATCH_VIEW_LAYER_NAME = "EMP_Solo_Batch"
+
+
+@dataclass(frozen=True, slots=True)
+class ViewLayerSpec:
+    name: str
+    passes: Tuple[str, ...] = ()
+    objects: Tuple[str, ...] = ()
+    use: bool = True
+    # Overrides the scene's sample count when above 0
+    samples: int = 0
+
+
+@dataclass(frozen=True, slots=True)
+class SceneSpec:
+    name: str
+    role: str
+    source: str = ""
+    view_layers: Tuple[ViewLayerSpec, ...] = ()
+    settings: Tuple[Tuple[str, object], ...] = ()
+
+
+@dataclass(frozen=True, slots=True)
+class NodeSpec:
+    name: str
+    node_type: str
+    props: Tuple[Tuple[str, object], ...] = ()
+    inputs: Tuple[Tuple[str|int, object], ...] = ()
+
+
+@dataclass(frozen=True, slots=True)
+class SlotSpec:
+    node: str
+    name: str
+    # The slot uses the node's format when file_format is empty
+    file_format: str = ""
+    color_mode: str = ""
+    color_depth: str = ""
+    compression: int = 15
+    exr_codec: str = ""
+    # Written with the Standard view transform, whatever the scene's color management is
+    use_standard_view: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class LinkSpec:
+    from_node: str
+    from_socket: str|int
+    to_node: str
+    to_socket: str|int
+
+
+@dataclass(frozen=True, slots=True)
+class DerivedImageSpec:
+    # A PNG written from a layer of the multilayer EXR after rendering, instead of by the compositor
+    name: str
+    layer: str
+    file_format: str = "PNG"
+    color_mode: str = "RGBA"
+    color_depth: str = "8"
+    compression: int = 15
+    exr_codec: str = ""
+
+
+@dataclass(frozen=True, slots=True)
+class ProfileSpec:
+    name: str
+    resolution_percentage: int = 100
+    max_samples: int = 0
+    subfolder: str = ""
+
+
+@dataclass(frozen=True, slots=True)
+class ExportPlan:
+    export_path: str
+    scenes: Tuple[SceneSpec, ...]
+    nodes: Tuple[NodeSpec, ...]
+    slots: Tuple[SlotSpec, ...]
+    links: Tuple[LinkSpec, ...]
+    # (start, end, step) when exporting an animation, None for the current frame only.
+    # It is left out of the content hash since it does not affect the graph
+    frame_range: Tuple[int, int, int]|None = None
+    # Reduced render settings of a preview export, None for a final export.
+    # Also left out of the hash, so that preview and final exports share the same graph
+    profile: ProfileSpec|None = None
+    # Problems found while compiling, which are reported but do not change the graph
+    warnings: Tuple[str, ...] = ()
+    derived_images: Tuple[DerivedImageSpec, ...] = ()
+    # (image, ((channel, mask name), ...)) of every image that masks are packed into
+    packed_masks: Tuple[Tuple[str, Tuple[Tuple[str, str], ...]], ...] = ()
+
+    def as_dict(self):
+        return {
+            "export_path" : self.export_path,
+            "scenes" : [_spec_as_list(i) for i in self.scenes],
+            "nodes" : [_spec_as_list(i) for i in self.nodes],
+            "slots" : [_spec_as_list(i) for i in self.slots],
+            "links" : [_spec_as_list(i) for i in self.links],
+        }
+
+    @property
+    def content_hash(self) -> str:
+        data = json.dumps(self.as_dict(), sort_keys=True, default=repr)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @property
+    def output_path(self) -> str:
+        if self.profile is None or not self.profile.subfolder:
+            return self.export_path
+
+        return self.export_path + self.profile.subfolder
+
+    def resolve_output_path(self, base_path) -> str:
+        if base_path.startswith(self.export_path):
+            return self.output_path + base_path[len(self.export_path):]
+
+        return base_path
+
+    @property
+    def frames(self) -> range|None:
+        if self.frame_range is None:
+            return None
+
+        start, end, step = self.frame_range
+        return range(start, end + 1, step)
+
+    @property
+    def render_count(self) -> int:
+        layer_count = sum(1 for scene in self.scenes for view_layer in scene.view_layers if view_layer.use)
+        frame_count = 1 if self.frames is None else len(self.frames)
+        return layer_count * frame_count
+
+    @property
+    def main_scene(self) -> SceneSpec:
+        return self.scenes[0]
+
+    @property
+    def shading_strategy(self) -> str|None:
+        if any(i.role == "SHADING" for i in self.scenes):
+            return "SCENE_COPY"
+        elif "light_directions" in dict(self.main_scene.settings):
+            return "LIGHTGROUPS"
+
+        return None
+
+    def describe(self) -> str:
+        lines = [
+            f"Export Plan {self.content_hash[:12]}",
+            f"Export Path: \"{self.export_path}\"",
+            f"Frames: {'Current' if self.frame_range is None else '{} - {} (step {})'.format(*self.frame_range)}",
+            f"Profile: {'Final' if self.profile is None else '{} ({}%, max {} samples)'.format(self.profile.name, self.profile.resolution_percentage, self.profile.max_samples)}",
+            f"Scenes ({len(self.scenes)}):",
+        ]
+
+        for scene in self.scenes:
+            source = f" from \"{scene.source}\"" if scene.source else ""
+            lines.append(f"    {scene.name} [{scene.role}]{source}")
+
+            for view_layer in scene.view_layers:
+                state = "" if view_layer.use else " (disabled)"
+                contents = ", ".join((*view_layer.passes, *view_layer.objects))
+                lines.append(f"        View Layer \"{view_layer.name}\"{state}: {contents}")
+
+        lines.append(f"Nodes ({len(self.nodes)}):")
+        lines.extend(f"    {node.name} [{node.node_type}]" for node in self.nodes)
+
+        lines.append(f"File Slots ({len(self.slots)}):")
+        lines.extend(f"    {slot.node} -> {slot.name}" for slot in self.slots)
+
+        if self.packed_masks:
+            lines.append(f"Packed Masks ({len(self.packed_masks)} images):")
+            lines.extend(f"    {image}: {', '.join(f'{mask} ({channel})' for channel, mask in channels)}" for image, channels in self.packed_masks)
+
+        if self.derived_images:
+            lines.append(f"Images Written from EXR ({len(self.derived_images)}):")
+            lines.extend(f"    {spec.layer} -> {spec.name}" for spec in self.derived_images)
+
+        lines.append(f"Links ({len(self.links)}):")
+        lines.extend(f"    {link.from_node}[{link.from_socket}] -> {link.to_node}[{link.to_socket}]" for link in self.links)
+
+        lines.append(f"Estimated Renders: {self.render_count}")
+        lines.extend(f"Warning: {warning}" for warning in self.warnings)
+        return "\n".join(lines)
+
+
+def _spec_as_list(spec):
+    values = []
+
+    for name in spec.__slots__:
+        value = getattr(spec, name)
+        if isinstance(value, tuple) and value and hasattr(value[0], "__slots__"):
+            value = [_spec_as_list(i) for i in value]
+        values.append(value)
+
+    return values
+
+
+@dataclass(slots=True)
+class PlanBuilder:
+    scenes: List[SceneSpec] = field(default_factory=list)
+    nodes: Dict[str, NodeSpec] = field(default_factory=dict)
+    slots: List[SlotSpec] = field(default_factory=list)
+    links: List[LinkSpec] = field(default_factory=list)
+
+    def add_scene(self, name, role, source="", view_layers=(), settings=()):
+        spec = SceneSpec(name, role, source, tuple(view_layers), tuple(settings))
+        self.scenes.append(spec)
+        return spec
+
+    def add_node(self, node_type, name, *_, inputs=(), **props):
+        self.nodes[name] = NodeSpec(name, node_type, tuple(props.items()), tuple(inputs))
+        return name
+
+    def add_slot(self, node, name, file_format="", color_mode="", color_depth="", compression=15, exr_codec="", use_standard_view=False):
+        self.slots.append(SlotSpec(node, name, file_format, color_mode, color_depth, compression, exr_codec, use_standard_view))
+        return name
+
+    def link(self, from_node, from_socket, to_node, to_socket):
+        self.links.append(LinkSpec(from_node, from_socket, to_node, to_socket))
+
+    def derive_images(self, image_node, exr_node):
+        # Replaces the file slots of image_node with images read from the EXR layers fed by the same sockets
+        # Slots without a matching EXR layer, like packed masks, are still written by image_node
+        exr_layers = {(i.from_node, i.from_socket) : i.to_socket for i in self.links if i.to_node == exr_node}
+        image_sources = {i.to_socket : (i.from_node, i.from_socket) for i in self.links if i.to_node == image_node}
+
+        derived = tuple(
+            DerivedImageSpec(slot.name, exr_layers[image_sources[slot.name]], slot.file_format or "PNG", slot.color_mode or "RGBA",
+                slot.color_depth or "8", slot.compression, slot.exr_codec)
+            for slot in self.slots if slot.node == image_node and image_sources.get(slot.name) in exr_layers
+            )
+        derived_names = set(i.name for i in derived)
+
+        self.slots = [i for i in self.slots if not (i.node == image_node and i.name in derived_names)]
+        self.links = [i for i in self.links if not (i.to_node == image_node and i.to_socket in derived_names)]
+        if not any(i.node == image_node for i in self.slots):
+            del self.nodes[image_node]
+        return derived
+
+    def build(self, export_path, frame_range=None, profile=None, warnings=(), derived_images=(), packed_masks=()):
+        return ExportPlan(
+            export_path=export_path,
+            scenes=tuple(self.scenes),
+            nodes=tuple(self.nodes.values()),
+            slots=tuple(self.slots),
+            links=tuple(self.links),
+            frame_range=frame_range,
+            profile=profile,
+            warnings=tuple(warnings),
+            derived_images=tuple(derived_images),
+            packed_masks=tuple(packed_masks),
+            )
+
+
+def compile_export_profile(props, profile):
+    if profile == "FINAL":
+        return None
+    elif profile == "PREVIEW":
+        return ProfileSpec("Preview",
+            resolution_percentage=props.preview_resolution_percentage,
+            max_samples=props.preview_max_samples,
+            subfolder=props.preview_subfolder,
+            )
+    else:
+        raise ValueError
+
+
+def compile_export_plan(scene, profile="FINAL") -> ExportPlan:
+    props = scene.EMP_Properties
+    prefs = fetch_user_preferences()
+    use_exr = prefs.view_passes_after_render
+    use_derived_images = use_exr and prefs.derive_images_from_exr and image_derivation.is_available()
+
+    export_path = props.export_path
+    passes = tuple(get_enabled_passes(props.render_passes))
+    masks = tuple(get_mask_layers())
+    selection_index = SelectionIndex(scene)
+
+    names = tuple(i.name for i in passes)
+    main_passes = tuple(i for i in names if i not in {"Shading", "Shadow", "Cavity"})
+    base_view_layer = scene.view_layers[0].name
+
+    # Shading can be computed from the Normal pass, in which case only Shadow needs a render with the EMP lights
+    compute_shading = ("Shading" in names) and props.shading_source == "NORMAL"
+    compute_cavity = ("Cavity" in names) and props.cavity_source == "COMPOSITOR"
+    if (compute_shading or compute_cavity) and "Normal" not in main_passes:
+        main_passes = (*main_passes, "Normal")
+
+    # Cryptomattes can come straight from the main render instead of a copy of the scene
+    matte_masks = tuple(i for i in masks if not i.solo)
+    use_main_cryptomatte = (props.cryptomatte_source == "MAIN") and len(matte_masks) > 0
+
+    mask_engine = scene.render.engine if use_main_cryptomatte else props.mask_engine
+    mask_indices, pass_indices = assign_mask_indices(scene, props, matte_masks, mask_engine, selection_index)
+
+    crypto_masks = tuple(i for i in matte_masks if i.name not in mask_indices)
+    matte_passes = (*cryptomatte_passes(crypto_masks, selection_index), *index_passes(mask_indices))
+    matte_settings = (("pass_indices", pass_indices),) if pass_indices else ()
+
+    use_shading = ("Shadow" in names) or (("Shading" in names) and not compute_shading)
+    shading_strategy = resolve_shading_strategy(scene) if use_shading else None
+    use_lightgroups = shading_strategy == "LIGHTGROUPS"
+
+    # Data passes only get their own view layer when it can take the place of the beauty layer in the render,
+    # otherwise they come with the beauty samples (and anti-aliasing) for free
+    other_passes = tuple(i for i in main_passes if i not in data_passes)
+    needs_beauty = any((
+        len(other_passes) > 0,
+        len(other_passes) == len(main_passes),
+        props.data_pass_samples == 0,
+        props.mask_type == "ALPHA" and len(masks) > 0,
+        use_main_cryptomatte,
+        use_lightgroups,
+        ))
+
+    data_layer_passes = () if needs_beauty else main_passes
+    beauty_passes = main_passes if needs_beauty else ()
+
+    if use_main_cryptomatte:
+        beauty_passes = (*beauty_passes, *matte_passes)
+
+    main_view_layers = [ViewLayerSpec(base_view_layer, passes=beauty_passes, use=needs_beauty)]
+    if data_layer_passes:
+        main_view_layers.append(ViewLayerSpec(DATA_VIEW_LAYER_NAME, passes=data_layer_passes, samples=props.data_pass_samples))
+
+    directions = light_directions(props)
+    lightgroups = tuple(name for i in range(len(directions)) for name in shading_lightgroup_names(i))
+    shading_settings = (("light_directions", tuple(direction for _, direction in directions)),)
+
+    main_settings = shading_settings if use_lightgroups else ()
+    if use_main_cryptomatte:
+        main_settings = (*main_settings, *matte_settings)
+
+    builder = PlanBuilder()
+    builder.add_scene(MAIN_SCENE_NAME, "MAIN", source=scene.name, view_layers=main_view_layers, settings=main_settings)
+
+    output_node = builder.add_node("CompositorNodeOutputFile", name="File Output (Images)", base_path=export_path, width=360, location=(500.0, 450.0))
+    if use_exr:
+        exr_output_node = builder.add_node("CompositorNodeOutputFile", name="File Output (EXR)", base_path=export_path + "Multilayer", width=360, location=(500.0, 160.0),
+            **{"format.file_format" : "OPEN_EXR_MULTILAYER", "format.exr_codec" : prefs.viewing_exr_codec})
+
+    if needs_beauty:
+        builder.add_node("CompositorNodeRLayers", name="Main Passes", scene=MAIN_SCENE_NAME, layer=base_view_layer, location=(0.0, 450.0))
+    if data_layer_passes:
+        builder.add_node("CompositorNodeRLayers", name="Data Passes", scene=MAIN_SCENE_NAME, layer=DATA_VIEW_LAYER_NAME, location=(0.0, 740.0))
+
+    if compute_shading:
+        add_normal_shading(builder, directions, start_location=(330.0, 1100.0))
+
+    if use_lightgroups:
+        builder.add_node("CompositorNodeRLayers", name="Shading Passes", scene=MAIN_SCENE_NAME, layer=base_view_layer, location=(0.0, 160.0))
+        add_clean_combined(builder, lightgroups, start_location=(250.0, 600.0))
+
+    elif use_shading:
+        builder.add_scene("EMP_Shading_and_Shadows", "SHADING", source=scene.name,
+            view_layers=(ViewLayerSpec(base_view_layer, passes=lightgroups),),
+            settings=shading_settings)
+        builder.add_node("CompositorNodeRLayers", name="Shading Passes", scene="EMP_Shading_and_Shadows", location=(0.0, 160.0))
+
+    if compute_cavity:
+        add_normal_cavity(builder, props, scene.camera, start_location=(330.0, -900.0))
+
+    elif ("Cavity" in names):
+        builder.add_scene("EMP_Workbench_Cavity", "CAVITY", source=scene.name,
+            view_layers=(ViewLayerSpec(base_view_layer, passes=("Combined",)),),
+            settings=(("ridge_factor", props.cavity_ridge_factor), ("valley_factor", props.cavity_valley_factor)))
+        builder.add_node("CompositorNodeRLayers", name="Cavity Pass", scene="EMP_Workbench_Cavity", location=(0.0, -60.0))
+
+    if "Direction Masks" in names:
+        dir_masks = props.direction_masks
+        if dir_masks.has_outputs:
+            builder.add_node("CompositorNodeSeparateXYZ", name="EMP_DirMaskXYZ", location=(330, 750))
+            dir_masks.add_nodes(builder, start_location=(490, 750))
+
+    crypto_scene = MAIN_SCENE_NAME if use_main_cryptomatte else "EMP_Cryptomatte"
+    # Bounds are only known for the current frame, so animations keep a view layer per mask
+    use_solo_batch = props.batch_solo_masks and not props.use_frame_range
+    solo_batch = batched_solo_masks(scene, masks, selection_index) if use_solo_batch else {}
+    add_mask_scenes(builder, scene, masks, selection_index, matte_passes=matte_passes, matte_settings=matte_settings,
+        use_main_cryptomatte=use_main_cryptomatte, solo_batch=solo_batch)
+
+    if mask_indices:
+        builder.add_node("CompositorNodeRLayers", name="Mask Indices", scene=crypto_scene, layer=base_view_layer, location=(-640.0, -400.0))
+
+    add_matte_masks(builder, props, masks, selection_index, start_location=(-320.0, -400.0), crypto_scene=crypto_scene,
+        solo_batch=solo_batch, mask_indices=mask_indices)
+
+    for render_pass in passes:
+        add_pass_outputs(builder, props, render_pass, output_node, is_exr=False)
+    packed_masks = ()
+    if props.mask_packing != "NONE" and props.mask_type == "BLACK_AND_WHITE" and len(masks) > 0:
+        packed_masks = add_packed_mask_outputs(builder, props, masks, output_node, start_location=(330.0, -1400.0))
+    else:
+        for mask in masks:
+            add_mask_outputs(builder, props, mask, output_node, is_exr=False)
+
+    if use_exr:
+        for render_pass in passes:
+            add_pass_outputs(builder, props, render_pass, exr_output_node, is_exr=True)
+        for mask in masks:
+            add_mask_outputs(builder, props, mask, exr_output_node, is_exr=True)
+
+    derived_images = builder.derive_images(output_node, exr_output_node) if use_derived_images else ()
+
+    frame_range = None
+    if props.use_frame_range:
+        frame_range = (props.frame_start, max(props.frame_start, props.frame_end), props.frame_step)
+
+    return builder.build(export_path, frame_range=frame_range, profile=compile_export_profile(props, profile),
+        warnings=selection_index.validate(masks), derived_images=derived_images, packed_masks=packed_masks)
+
+
+def mask_settings(props):
+    return (
+        ("mask_engine", props.mask_engine),
+        ("mask_eevee_samples", props.mask_eevee_samples),
+        ("mask_cycles_samples", props.mask_cycles_samples),
+        )
+
+
+def resolve_shading_strategy(scene):
+    # Lightgroups are only available in Cycles, and aren't denoised, so subtracting them from a denoised Combined would add noise back
+    if scene.EMP_Properties.shading_strategy == "LIGHTGROUPS" and scene.render.engine == 'CYCLES' and not scene.cycles.use_denoising:
+        return "LIGHTGROUPS"
+
+    return "SCENE_COPY"
+
+
+def light_directions(props):
+    # Output suffix & rotation of the main light direction, followed by the extra ones
+    directions = [("", tuple(props.light_direction))]
+    suffixes = {""}
+
+    for i, light in enumerate(props.extra_light_directions, start=1):
+        suffix = f"_{light.name.replace('.', '_')}"
+        if suffix in suffixes:
+            suffix = f"_{i:02d}"
+
+        suffixes.add(suffix)
+        directions.append((suffix, tuple(light.direction)))
+
+    return tuple(directions)
+
+
+def light_vector(direction):
+    # Unit vector pointing towards a sun light with the given rotation
+    return tuple(Euler(direction).to_matrix() @ Vector((0.0, 0.0, 1.0)))
+
+
+def add_normal_shading(builder, directions, start_location):
+    # Clamped N·L scaled by the 0.8 albedo of the blank material, which is what the rendered Shading pass holds
+    normal_xyz = builder.add_node("CompositorNodeSeparateXYZ", name="EMP_ShadingNormalXYZ", location=start_location)
+    builder.link(*pass_socket(builder, "Normal"), normal_xyz, "Vector")
+
+    for i, (suffix, direction) in enumerate(directions):
+        x, y = start_location[0] + 160.0, start_location[1] - i*180.0
+        lx, ly, lz = light_vector(direction)
+
+        dot_x = builder.add_node("CompositorNodeMath", name=f"EMP_NdotL_X{suffix}", operation="MULTIPLY",
+            location=(x, y), hide=True, inputs=((1, lx),))
+        dot_y = builder.add_node("CompositorNodeMath", name=f"EMP_NdotL_Y{suffix}", operation="MULTIPLY_ADD",
+            location=(x, y - 45), hide=True, inputs=((1, ly),))
+        dot_z = builder.add_node("CompositorNodeMath", name=f"EMP_NdotL_Z{suffix}", operation="MULTIPLY_ADD", use_clamp=True,
+            location=(x, y - 90), hide=True, inputs=((1, lz),))
+        shading = builder.add_node("CompositorNodeMath", name=f"EMP_Shading{suffix}", label=f"Shading{suffix}", operation="MULTIPLY",
+            location=(x, y - 135), hide=True, inputs=((1, 0.8),))
+
+        builder.link(normal_xyz, "X", dot_x, 0)
+        builder.link(normal_xyz, "Y", dot_y, 0)
+        builder.link(dot_x, "Value", dot_y, 2)
+        builder.link(normal_xyz, "Z", dot_z, 0)
+        builder.link(dot_y, "Value", dot_z, 2)
+        builder.link(dot_z, "Value", shading, 0)
+
+
+def camera_axes(camera):
+    if camera is None:
+        return (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)
+
+    rotation = camera.matrix_world.to_3x3().normalized()
+    return tuple(rotation.col[0]), tuple(rotation.col[1])
+
+
+def add_dot_product(builder, name, input_node, vector, location):
+    # Dot product of a separated XYZ vector and a constant, as a chain of Math nodes
+    x, y, z = vector
+    dot_x = builder.add_node("CompositorNodeMath", name=f"{name}_X", operation="MULTIPLY",
+        location=location, hide=True, inputs=((1, x),))
+    dot_y = builder.add_node("CompositorNodeMath", name=f"{name}_Y", operation="MULTIPLY_ADD",
+        location=(location[0], location[1] - 45), hide=True, inputs=((1, y),))
+    dot_z = builder.add_node("CompositorNodeMath", name=name, operation="MULTIPLY_ADD",
+        location=(location[0], location[1] - 90), hide=True, inputs=((1, z),))
+
+    builder.link(input_node, "X", dot_x, 0)
+    builder.link(input_node, "Y", dot_y, 0)
+    builder.link(dot_x, "Value", dot_y, 2)
+    builder.link(input_node, "Z", dot_z, 0)
+    builder.link(dot_y, "Value", dot_z, 2)
+    return dot_z
+
+
+def add_normal_cavity(builder, props, camera, start_location):
+    # Screen-space curvature: the divergence of the camera-space normals, measured across the cavity radius.
+    # Ridges (positive) brighten and valleys (negative) darken a 0.5 grey base, like Workbench's curvature
+    x, y = start_location
+    radius = props.cavity_radius
+    right, up = camera_axes(camera)
+
+    normal_xyz = builder.add_node("CompositorNodeSeparateXYZ", name="EMP_CavityNormalXYZ", location=(x, y))
+    builder.link(*pass_socket(builder, "Normal"), normal_xyz, "Vector")
+
+    derivatives = []
+    for axis, vector, row in (("X", right, 0), ("Y", up, 1)):
+        location = (x + 160.0, y - row*300.0)
+        normal = add_dot_product(builder, f"EMP_CavityNormal{axis}", normal_xyz, vector, location)
+
+        offsets = {}
+        for sign, offset in (("Pos", radius), ("Neg", -radius)):
+            translate = builder.add_node("CompositorNodeTranslate", name=f"EMP_CavityShift{axis}{sign}",
+                location=(location[0] + 160.0, location[1] - len(offsets)*45), hide=True,
+                inputs=((axis, float(offset)),))
+            builder.link(normal, "Value", translate, "Image")
+            offsets[sign] = translate
+
+        # Shifting by -radius samples the normal at +radius
+        derivative = builder.add_node("CompositorNodeMath", name=f"EMP_CavityDerivative{axis}", operation="SUBTRACT",
+            location=(location[0] + 320.0, location[1]), hide=True)
+        builder.link(offsets["Neg"], "Image", derivative, 0)
+        builder.link(offsets["Pos"], "Image", derivative, 1)
+        derivatives.append(derivative)
+
+    x += 640.0
+    curvature = builder.add_node("CompositorNodeMath", name="EMP_CavityCurvature", operation="ADD",
+        location=(x, y), hide=True)
+    builder.link(derivatives[0], "Value", curvature, 0)
+    builder.link(derivatives[1], "Value", curvature, 1)
+
+    ridge = builder.add_node("CompositorNodeMath", name="EMP_CavityRidge", operation="MAXIMUM",
+        location=(x + 160.0, y), hide=True, inputs=((1, 0.0),))
+    valley = builder.add_node("CompositorNodeMath", name="EMP_CavityValley", operation="MINIMUM",
+        location=(x + 160.0, y - 45), hide=True, inputs=((1, 0.0),))
+    builder.link(curvature, "Value", ridge, 0)
+    builder.link(curvature, "Value", valley, 0)
+
+    ridge_factor = builder.add_node("CompositorNodeMath", name="EMP_CavityRidgeFactor", operation="MULTIPLY",
+        location=(x + 320.0, y), hide=True, inputs=((1, props.cavity_ridge_factor * 0.5),))
+    valley_factor = builder.add_node("CompositorNodeMath", name="EMP_CavityValleyFactor", operation="MULTIPLY_ADD",
+        location=(x + 320.0, y - 45), hide=True, inputs=((1, props.cavity_valley_factor * 0.5),))
+    builder.link(ridge, "Value", ridge_factor, 0)
+    builder.link(valley, "Value", valley_factor, 0)
+    builder.link(ridge_factor, "Value", valley_factor, 2)
+
+    cavity = builder.add_node("CompositorNodeMath", name="EMP_Cavity", label="Cavity", operation="MULTIPLY_ADD", use_clamp=True,
+        location=(x + 480.0, y), hide=True, inputs=((1, 0.5), (2, 0.5)))
+    builder.link(valley_factor, "Value", cavity, 0)
+
+
+def add_clean_combined(builder, lightgroups, start_location):
+    # The EMP suns light the main render too, so their lightgroups are taken back out of its Combined pass
+    input_node = "Main Passes"
+
+    for i, lightgroup in enumerate(lightgroups):
+        is_last = (i == len(lightgroups) - 1)
+        node_name = "Clean Combined" if is_last else f"EMP_Remove_{lightgroup}"
+
+        builder.add_node("CompositorNodeMixRGB", name=node_name, label=node_name if is_last else "", blend_type="SUBTRACT",
+            location=(start_location[0], start_location[1] - i*45), hide=True)
+        builder.link(input_node, "Image", node_name, 1)
+        builder.link("Shading Passes", f"Combined_{lightgroup}", node_name, 2)
+        input_node = node_name
+
+
+def mask_backend(props, mask):
+    return props.mask_backend if mask.backend == "DEFAULT" else mask.backend
+
+
+def assign_mask_indices(scene, props, masks, engine, selection_index):
+    # Index passes only exist in Cycles, so every mask falls back to cryptomatte in other engines
+    if engine != 'CYCLES':
+        return {}, ()
+
+    # Indices start above the ones already in use, so that other objects never end up in a mask
+    next_indices = {
+        "OBJECT" : max((obj.pass_index for obj in scene.collection.all_objects), default=0) + 1,
+        "MATERIAL" : max((mat.pass_index for mat in bpy.data.materials), default=0) + 1,
+    }
+    assigned = {"OBJECT" : {}, "MATERIAL" : {}}
+    index_members = {"OBJECT" : {}, "MATERIAL" : {}}
+    mask_indices = {}
+
+    for mask in masks:
+        if mask_backend(props, mask) != "PASS_INDEX":
+            continue
+
+        if mask.selection_type == "MATERIAL":
+            id_type = "MATERIAL"
+            id_data = () if mask.selection_material is None else (mask.selection_material,)
+        else:
+            id_type = "OBJECT"
+            id_data = tuple(selection_index.mask_objects(mask))
+
+        # Linked data keeps its own pass index, so those masks use cryptomatte
+        if any(i.library is not None for i in id_data):
+            continue
+
+        names = frozenset(i.name for i in id_data)
+
+        # An object or material can only carry one index, so masks only share one when they select the exact same data,
+        # and the other masks that overlap them keep using cryptomatte
+        existing = set(assigned[id_type][i] for i in names if i in assigned[id_type])
+        if existing:
+            index = existing.pop()
+            if existing or index_members[id_type][index] != names:
+                continue
+        else:
+            index = next_indices[id_type]
+            next_indices[id_type] += 1
+            index_members[id_type][index] = names
+
+        for name in names:
+            assigned[id_type][name] = index
+        mask_indices[mask.name] = (id_type, index)
+
+    pass_indices = tuple((id_type, name, index) for id_type, names in assigned.items() for name, index in sorted(names.items()))
+    return mask_indices, pass_indices
+
+
+def index_passes(mask_indices):
+    id_types = set(id_type for id_type, _ in mask_indices.values())
+    return tuple(name for id_type, name in (("OBJECT", "Object index"), ("MATERIAL", "Material index")) if id_type in id_types)
+
+
+def cryptomatte_passes(masks, selection_index):
+    crypto_passes = set()
+    for mask in masks:
+        crypto_pass, _ = matte_selection(mask, selection_index)
+        crypto_passes.add(crypto_pass)
+
+    return tuple(sorted(crypto_passes))
+
+
+def screen_bounds(scene, objects):
+    # Camera view rectangle around the bounding boxes of the objects, or None when it can't be known for sure
+    camera = scene.camera
+    if camera is None:
+        return None
+
+    xs, ys = [], []
+    for obj in objects:
+        if obj.instance_type != 'NONE' and obj.type == 'EMPTY':
+            return None
+
+        for corner in obj.bound_box:
+            x, y, z = world_to_camera_view(scene, camera, obj.matrix_world @ Vector(corner))
+            if z <= 0.0:
+                return None
+            xs.append(x)
+            ys.append(y)
+
+    if len(xs) == 0:
+        return None
+
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def bounds_overlap(a, b, margin=0.005):
+    return not (a[2] + margin < b[0] or b[2] + margin < a[0] or a[3] + margin < b[1] or b[3] + margin < a[1])
+
+
+def batched_solo_masks(scene, masks, selection_index):
+    # Solo masks that cover a separate part of the camera view from every earlier one are rendered together
+    # and separated by cryptomatte, the others keep a view layer of their own
+    solo_batch = {}
+    batched_bounds = []
+
+    for mask in masks:
+        if not mask.solo:
+            continue
+
+        objects = tuple(selection_index.mask_objects(mask))
+        bounds = screen_bounds(scene, objects)
+        if bounds is None or any(bounds_overlap(bounds, i) for i in batched_bounds):
+            continue
+
+        solo_batch[mask.name] = tuple(obj.name for obj in objects)
+        batched_bounds.append(bounds)
+
+    return solo_batch
+
+
+def mask_socket(builder, mask):
+    return "Matte" if builder.nodes[mask.name].node_type == "CompositorNodeCryptomatteV2" else "Alpha"
+
+
+def add_mask_scenes(builder, scene, masks, selection_index, matte_passes=(), matte_settings=(), use_main_cryptomatte=False, solo_batch=()):
+    props = scene.EMP_Properties
+    matte_masks = tuple(i for i in masks if not i.solo)
+    solo_masks = tuple(i for i in masks if i.solo)
+
+    if len(matte_masks) > 0 and not use_main_cryptomatte:
+        builder.add_scene("EMP_Cryptomatte", "CRYPTOMATTE", source=scene.name,
+            view_layers=(ViewLayerSpec(scene.view_layers[0].name, passes=matte_passes),),
+            settings=(*mask_settings(props), *matte_settings))
+
+    if len(solo_masks) > 0:
+        # The default view layer of the solo scene is empty, so it is left out of the render
+        view_layers = [ViewLayerSpec("ViewLayer", use=False)]
+
+        if solo_batch:
+            objects = tuple(sorted(set(name for names in solo_batch.values() for name in names)))
+            view_layers.append(ViewLayerSpec(SOLO_BATCH_VIEW_LAYER_NAME, passes=("CryptoObject",), objects=objects))
+
+        for mask in solo_masks:
+            if mask.name in solo_batch:
+                continue
+
+            objects = tuple(obj.name for obj in selection_index.mask_objects(mask))
+            view_layers.append(ViewLayerSpec(mask.view_layer_name, passes=("Combined",), objects=objects))
+
+        camera = "" if scene.camera is None else scene.camera.name
+        builder.add_scene("EMP_Solo_Masks", "SOLO", view_layers=view_layers,
+            settings=(*mask_settings(props), ("camera", camera)))
+
+
+def add_matte_masks(builder, props, masks, selection_index, start_location, crypto_scene="EMP_Cryptomatte", solo_batch=(), mask_indices=()):
+    for i, mask in enumerate(masks):
+        location = (start_location[0], start_location[1] - i*45)
+
+        if mask.name in mask_indices:
+            id_type, index = mask_indices[mask.name]
+            builder.add_node("CompositorNodeIDMask", name=mask.name, label=mask.name, index=index, use_antialiasing=True,
+                location=location, hide=True)
+            builder.link("Mask Indices", "IndexOB" if id_type == "OBJECT" else "IndexMA", mask.name, "ID value")
+        elif mask.name in solo_batch:
+            builder.add_node("CompositorNodeCryptomatteV2", name=mask.name, label=mask.name,
+                scene="EMP_Solo_Masks", layer_name=f"{SOLO_BATCH_VIEW_LAYER_NAME}.CryptoObject", matte_id=", ".join(solo_batch[mask.name]),
+                location=location, hide=True)
+        elif mask.solo:
+            builder.add_node("CompositorNodeRLayers", name=mask.name, label=mask.name,
+                scene="EMP_Solo_Masks", layer=mask.view_layer_name, location=location, hide=True)
+        else:
+            crypto_pass, matte_id = matte_selection(mask, selection_index)
+            builder.add_node("CompositorNodeCryptomatteV2", name=mask.name, label=mask.name,
+                scene=crypto_scene, layer_name=f"{mask.view_layer_name}.{crypto_pass}", matte_id=matte_id,
+                location=location, hide=True)
+
+        sock_name = mask_socket(builder, mask)
+
+        if mask.invert:
+            invert_node = builder.add_node("CompositorNodeMath", name=f"Invert_{mask.name}", label="Invert", operation="SUBTRACT",
+                location=(location[0] + 260.0, location[1]), hide=True, inputs=((0, 1.0),))
+            builder.link(mask.name, sock_name, invert_node, 1)
+
+        if props.mask_type == "ALPHA":
+            set_alpha = builder.add_node("CompositorNodeSetAlpha", name=f"Alpha_{mask.name}", mode="REPLACE_ALPHA",
+                location=(location[0] + 420.0, location[1]), hide=True)
+
+            if mask.invert:
+                builder.link(invert_node, "Value", set_alpha, "Alpha")
+            else:
+                builder.link(mask.name, sock_name, set_alpha, "Alpha")
+
+
+def pass_socket(builder, pass_name):
+    input_node, input_soc = pass_link_map[pass_name]
+
+    if input_node == "Main Passes" and pass_name in data_passes and "Data Passes" in builder.nodes:
+        input_node = "Data Passes"
+    elif pass_name == "Combined" and "Clean Combined" in builder.nodes:
+        input_node, input_soc = "Clean Combined", "Image"
+    elif pass_name == "Cavity" and "EMP_Cavity" in builder.nodes:
+        input_node, input_soc = "EMP_Cavity", "Value"
+
+    return input_node, input_soc
+
+
+def add_pass_outputs(builder, props, render_pass, output_node, is_exr):
+    pass_name = render_pass.name
+
+    if pass_name == "Direction Masks":
+        dir_masks = props.direction_masks
+        if dir_masks.has_outputs:
+            input_node, input_soc = pass_socket(builder, pass_name)
+            if not is_exr:
+                builder.link(input_node, input_soc, "EMP_DirMaskXYZ", "Vector")
+
+            dir_masks.create_outputs(builder, output_node, is_exr=is_exr, slot_format=render_pass.slot_format)
+            dir_masks.link_sockets(builder, output_node, is_exr=is_exr)
+
+    elif pass_name in {"Shading", "Shadow"}:
+        for i, (suffix, _) in enumerate(light_directions(props)):
+            lightgroup = shading_lightgroup_names(i)[pass_name == "Shadow"]
+            if is_exr:
+                slot_name = builder.add_slot(output_node, f"Image.{pass_name}{suffix}")
+            else:
+                slot_name = builder.add_slot(output_node, f"{pass_name}{suffix}", **render_pass.slot_format)
+
+            if f"EMP_Shading{suffix}" in builder.nodes and pass_name == "Shading":
+                builder.link(f"EMP_Shading{suffix}", "Value", output_node, slot_name)
+            else:
+                builder.link("Shading Passes", f"Combined_{lightgroup}", output_node, slot_name)
+
+    else:
+        input_node, input_soc = pass_socket(builder, pass_name)
+
+        if is_exr:
+            slot_name = builder.add_slot(output_node, render_pass.exr_output_name)
+        else:
+            slot_name = builder.add_slot(output_node, pass_name, **render_pass.slot_format)
+        builder.link(input_node, input_soc, output_node, slot_name)
+
+
+def mask_output_socket(builder, props, mask, is_exr):
+    if props.mask_type == "ALPHA":
+        input_node = f"Alpha_{mask.name}"
+        input_soc = "Image"
+
+        if not is_exr:
+            builder.link(*pass_socket(builder, "Combined"), input_node, input_soc)
+    else:
+        if not mask.invert:
+            input_node = mask.name
+            input_soc = mask_socket(builder, mask)
+        else:
+            input_node = f"Invert_{mask.name}"
+            input_soc = 0
+
+    return input_node, input_soc
+
+
+def add_mask_outputs(builder, props, mask, output_node, is_exr):
+    input_node, input_soc = mask_output_socket(builder, props, mask, is_exr)
+
+    if is_exr:
+        slot_name = builder.add_slot(output_node, mask.exr_output_name)
+    else:
+        slot_name = builder.add_slot(output_node, mask.name, **mask.slot_format(props.mask_type))
+
+    builder.link(input_node, input_soc, output_node, slot_name)
+
+
+def add_packed_mask_outputs(builder, props, masks, output_node, start_location):
+    # Black & white masks share images, one mask per color channel
+    file_format = props.mask_packing
+    if file_format == "PNG":
+        # PNGs store straight alpha, which would wipe out the other channels wherever a mask in alpha is 0.
+        # The scene's view transform could also mix the channels, so they are written with Standard
+        channels = ("Red", "Green", "Blue")
+        slot_format = {"file_format" : "PNG", "color_mode" : "RGB", "color_depth" : "8", "use_standard_view" : True}
+    else:
+        channels = ("Red", "Green", "Blue", "Alpha")
+        slot_format = {"file_format" : "OPEN_EXR", "color_mode" : "RGBA", "color_depth" : "16", "exr_codec" : "ZIP"}
+
+    packed_masks = []
+    for i in range(0, len(masks), len(channels)):
+        group = masks[i:i + len(channels)]
+        slot_name = f"Masks_{i // len(channels) + 1:02d}"
+        node_name = f"EMP_Packed_{slot_name}"
+        location = (start_location[0], start_location[1] - len(packed_masks)*45)
+
+        builder.add_node("CompositorNodeCombineColor", name=node_name, label=slot_name, mode="RGB", location=location, hide=True,
+            inputs=tuple((channel, 0.0) for channel in channels))
+
+        for channel, mask in zip(channels, group):
+            builder.link(*mask_output_socket(builder, props, mask, is_exr=False), node_name, channel)
+
+        builder.add_slot(output_node, slot_name, **slot_format)
+        builder.link(node_name, "Image", output_node, slot_name)
+
+        packed_masks.append((slot_name, tuple((channel[0], mask.name) for channel, mask in zip(channels, group))))
+
+    return tuple(packed_masks)
+
+
+def init_helper_scene(scene, spec):
+    role = spec.role
+
+    if role == "MAIN":
+        init_main_passes_scene(scene, spec.view_layers, light_directions=dict(spec.settings).get("light_directions"))
+    elif role == "SHADING":
+        init_shading_scene(scene, dict(spec.settings)["light_directions"])
+    elif role == "CAVITY":
+        init_cavity_scene(scene, **dict(spec.settings))
+    elif role == "CRYPTOMATTE":
+        init_cryptomatte_scene(scene, spec.view_layers[0].passes)
+    elif role == "SOLO":
+        init_solo_scene(scene)
+        create_solo_view_layers(scene, spec.view_layers[1:])
+    else:
+        raise ValueError
+
+
+def set_node_prop(node, prop, value):
+    *path, attr = prop.split(".")
+    data = node
+    for i in path:
+        data = getattr(data, i)
+
+    if attr == "scene":
+        value = bpy.data.scenes[value]
+    elif attr == "image":
+        value = load_multilayer_file(value)
+
+    setattr(data, attr, value)
+
+
+def apply_export_plan(plan, base_scene):
+    apply_plan_scenes(plan, base_scene)
+    return apply_plan_graph(plan)
+
+
+def apply_plan_scenes(plan, base_scene):
+    restore_pass_indices()
+
+    for spec in plan.scenes:
+        scene = ensure_scene(base_scene if spec.source else None, spec.name)
+        init_helper_scene(scene, spec)
+        assign_pass_indices(dict(spec.settings).get("pass_indices", ()))
+
+    # Pooled helper scenes that this export doesn't need are kept for the next one
+    if not helper_pool_enabled():
+        remove_helper_scenes(keep=set(i.name for i in plan.scenes))
+
+    if plan.profile is not None:
+        for spec in plan.scenes:
+            apply_preview_settings(bpy.data.scenes[spec.name], plan.profile.resolution_percentage, plan.profile.max_samples)
+
+    if plan.frame_range is not None:
+        main_scene = bpy.data.scenes[plan.main_scene.name]
+        main_scene.frame_start, main_scene.frame_end, main_scene.frame_step = plan.frame_range
+
+        # Keep BVHs and compiled shaders around between the frames of the animation
+        for spec in plan.scenes:
+            bpy.data.scenes[spec.name].render.use_persistent_data = True
+
+
+def apply_plan_graph(plan):
+    main_scene = bpy.data.scenes[plan.main_scene.name]
+    content_hash = plan.content_hash
+
+    # Nothing in the graph changed since the last export, so it can be rendered as-is
+    if main_scene.get("emp_plan_hash") == content_hash:
+        set_output_paths(plan, main_scene.node_tree)
+        return main_scene, False
+
+    tree = main_scene.node_tree
+    nodes = tree.nodes
+    begin_graph_build(tree)
+
+    for spec in plan.nodes:
+        node = add_node(tree, spec.node_type, name=spec.name)
+        for prop, value in spec.props:
+            set_node_prop(node, prop, value)
+
+        for socket, value in spec.inputs:
+            node.inputs[socket].default_value = value
+
+    prune_graph(tree)
+
+    slot_names = {}
+    for spec in plan.slots:
+        slot_names.setdefault(spec.node, []).append(spec.name)
+        slot = ensure_file_slot(nodes[spec.node].file_slots, spec.name)
+
+        if spec.file_format:
+            slot.use_node_format = False
+            slot_format = slot.format
+            slot_format.file_format = spec.file_format
+            slot_format.color_mode = spec.color_mode
+            slot_format.color_depth = spec.color_depth
+
+            if spec.file_format == "PNG":
+                slot_format.compression = spec.compression
+            else:
+                slot_format.exr_codec = spec.exr_codec
+
+            if spec.use_standard_view:
+                slot_format.color_management = 'OVERRIDE'
+                slot_format.display_settings.display_device = 'sRGB'
+                set_standard_view_settings(slot_format.view_settings)
+            else:
+                slot_format.color_management = 'FOLLOW_SCENE'
+
+    for node in nodes:
+        if node.bl_idname == "CompositorNodeOutputFile":
+            prune_file_slots(node, slot_names.get(node.name, ()))
+
+    links = []
+    for spec in plan.links:
+        output_socket = nodes[spec.from_node].outputs[spec.from_socket]
+        input_socket = nodes[spec.to_node].inputs[spec.to_socket]
+        links.append(link_sockets(tree, output_socket, input_socket))
+
+    prune_links(tree, links)
+
+    set_output_paths(plan, tree)
+
+    main_scene["emp_plan_hash"] = content_hash
+    return main_scene, True
+
+
+def write_packed_mask_index(plan):
+    if len(plan.packed_masks) == 0:
+        return
+
+    output_path = bpy.path.abspath(plan.output_path)
+    os.makedirs(output_path, exist_ok=True)
+
+    index = {image : dict(channels) for image, channels in plan.packed_masks}
+    with open(os.path.join(output_path, "Masks.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=4)
+
+
+def set_output_paths(plan, tree):
+    # Preview exports are written to their own folder without changing the graph itself
+    for spec in plan.nodes:
+        props = dict(spec.props)
+        if "base_path" in props:
+            tree.nodes[spec.name].base_path = plan.resolve_output_path(props["base_path"])
@@ -7,17 +7,20 @@ from bpy.props import (
     BoolProperty,
     CollectionProperty,
     EnumProperty,
+    FloatProperty,
     FloatVectorProperty,
     IntProperty,
     PointerProperty,
     StringProperty,
     )
 
+import json
 import re
 from collections import Counter
 
+from .export_job import load_queue_progress
 from .keymaps import keymap_layout
-from .utils import add_node, fetch_user_preferences, get_addon_property, get_addon_properties, ui_draw_enum_prop
+from .utils import data_passes, fetch_user_preferences, get_addon_property, get_addon_properties, restore_pass_indices, ui_draw_enum_prop
 
 from bpy.app.handlers import persistent
 
@@ -46,22 +49,129 @@ def setDefaultCollectionValue():
             prop_item.name = default
 
 
+exr_codec_items = (
+    ("NONE", "None", ""),
+    ("ZIP", "ZIP", "Lossless, good for renders with noise or grain"),
+    ("PIZ", "PIZ", "Lossless wavelet compression, good for noisy images"),
+    ("DWAA", "DWAA", "Lossy, much smaller files for passes that don't need exact values"),
+    ("B44", "B44", "Lossy, fast to read back, only compresses half float images"),
+    )
+
+# Formats picked by "Auto", by pass name or "Mask" / "Alpha Mask"
+default_output_formats = {
+    "Normal" : ("OPEN_EXR", "RGB", "16"),
+    "Mist" : ("PNG", "BW", "16"),
+    "Direction Masks" : ("PNG", "BW", "8"),
+    "Mask" : ("PNG", "BW", "8"),
+    "Alpha Mask" : ("PNG", "RGBA", "8"),
+}
+fallback_output_format = ("PNG", "RGBA", "8")
+
+
+class EMPOutputFormat(PropertyGroup):
+    file_format: EnumProperty(name="Format", default="AUTO", options=set(),
+        items=(
+            ("AUTO", "Auto", "Use the default format of this kind of output"),
+            ("PNG", "PNG", ""),
+            ("OPEN_EXR", "OpenEXR", ""),
+            ),
+        )
+    color_mode: EnumProperty(name="Color", default="AUTO", options=set(),
+        items=(
+            ("AUTO", "Auto", "Use the default color channels of this kind of output"),
+            ("BW", "BW", ""),
+            ("RGB", "RGB", ""),
+            ("RGBA", "RGBA", ""),
+            ),
+        )
+    png_depth: EnumProperty(name="Color Depth", default="8", options=set(),
+        items=(("8", "8", ""), ("16", "16", "")),
+        )
+    exr_depth: EnumProperty(name="Color Depth", default="16", options=set(),
+        items=(("16", "Float (Half)", ""), ("32", "Float (Full)", "")),
+        )
+    compression: IntProperty(name="Compression", default=15, min=0, max=100, subtype="PERCENTAGE", options=set())
+    exr_codec: EnumProperty(name="Codec", default="ZIP", items=exr_codec_items, options=set())
+
+    def slot_format(self, default):
+        file_format, color_mode, color_depth = default_output_formats.get(default, fallback_output_format)
+
+        if self.file_format != "AUTO":
+            file_format = self.file_format
+            color_depth = self.png_depth if file_format == "PNG" else self.exr_depth
+        if self.color_mode != "AUTO":
+            color_mode = self.color_mode
+
+        slot_format = {"file_format" : file_format, "color_mode" : color_mode, "color_depth" : color_depth}
+        if file_format == "PNG":
+            slot_format["compression"] = self.compression
+        else:
+            slot_format["exr_codec"] = self.exr_codec
+
+        return slot_format
+
+    def draw(self, layout, default):
+        slot_format = self.slot_format(default)
+
+        col = layout.column()
+        col.prop(self, "file_format")
+        col.prop(self, "color_mode")
+
+        if self.file_format != "AUTO":
+            col.prop(self, "png_depth" if self.file_format == "PNG" else "exr_depth")
+        if slot_format["file_format"] == "PNG":
+            col.prop(self, "compression")
+        else:
+            col.prop(self, "exr_codec")
+
+
 class EMPRenderPass(PropertyGroup):
     def __repr__(self):
         return f"bpy.data.scenes['{bpy.context.scene.name}'].{self.__class__.__name__}['{self.name}']"
 
     name: StringProperty(name="Name", default="Default")
     render: BoolProperty(name="Render", default=True, options=set())
+    output_format: PointerProperty(name="Output Format", type=EMPOutputFormat)
 
     @property
     def exr_output_name(self):
         return f'Image.{self.name.replace(".", "_")}'
 
+    @property
+    def slot_format(self):
+        return self.output_format.slot_format(self.name)
+
     def draw(self, layout):
         col = layout.column()
         if self.name in {"Shading", "Shadow"}:
             data = get_addon_properties()
             col.prop(data, "light_direction")
+            col.prop(data, "shading_source")
+            col.prop(data, "shading_strategy")
+
+            col.label(text="Extra Light Directions:")
+            row = col.row()
+            row.template_list("EMP_PT_UL_LIGHT_DIRECTIONS", "", data, "extra_light_directions", data, "active_light_direction_index", rows=2)
+
+            ops_col = row.column(align=True)
+            ops_col.operator("render.emp_add_light_direction", icon='ADD', text="")
+            ops_col.operator("render.emp_remove_light_direction", icon='REMOVE', text="")
+
+        if self.name == "Cavity":
+            data = get_addon_properties()
+            col.prop(data, "cavity_source")
+
+            sub = col.column(align=True)
+            sub.prop(data, "cavity_ridge_factor")
+            sub.prop(data, "cavity_valley_factor")
+
+            sub = col.column()
+            sub.active = data.cavity_source == "COMPOSITOR"
+            sub.prop(data, "cavity_radius")
+
+        if self.name in data_passes:
+            data = get_addon_properties()
+            col.prop(data, "data_pass_samples")
             
         if self.name == "Freestyle":
             layout.use_property_split = True
@@ -73,6 +183,47 @@ class EMPRenderPass(PropertyGroup):
             if rd.line_thickness_mode == 'ABSOLUTE':
                 layout.prop(rd, "line_thickness", text="Thickness")
 
+        header, panel = layout.panel(f"EMP_PT_OUTPUT_FORMAT_{self.name.replace(' ', '_')}", default_closed=True)
+        header.label(text="Output Format")
+        if panel:
+            panel.use_property_split = True
+            self.output_format.draw(panel, self.name)
+
+
+class EMPLightDirection(PropertyGroup):
+    name: StringProperty(name="Name", default="Light")
+    direction: FloatVectorProperty(name="Direction", subtype="EULER", precision=5, step=100, options=set(),
+        description="The direction of the lighting calculated in this light's Shading & Shadow outputs"
+        )
+
+
+class MaskNameIndex:
+    # Names taken by a mask collection, plus the next free suffix of each stem,
+    # so that adding many masks doesn't rescan the collection for every name
+    def __init__(self, names=()):
+        self.names = set(names)
+        self.next_suffix = {}
+
+    @staticmethod
+    def unduped_name(name):
+        unduped_name, *_ = re.split("\.\d+$", name)
+        return unduped_name
+
+    def unique_name(self, name):
+        if name in self.names:
+            stem = self.unduped_name(name)
+            counter = self.next_suffix.get(stem, 1)
+
+            name = f"{stem}.{counter:03d}"
+            while name in self.names:
+                counter += 1
+                name = f"{stem}.{counter:03d}"
+
+            self.next_suffix[stem] = counter + 1
+
+        self.names.add(name)
+        return name
+
 
 class EMPMaskLayer(PropertyGroup):
     def parent_collection(self):
@@ -92,23 +243,15 @@ class EMPMaskLayer(PropertyGroup):
 
     @staticmethod
     def unduped_name(name):
-        unduped_name, *_ = re.split("\.\d+$", name)
-        return unduped_name
+        return MaskNameIndex.unduped_name(name)
 
     def make_name_unique(self, name):
         collection = self.parent_collection()
-        counter = 1
-        names = set(i.name for i in collection)
-
-        stem = self.unduped_name(name)
+        names = Counter(i.name for i in collection)
 
-        counts = Counter(i.name for i in collection)
-        should_change_name = (counts[name] > 1)
-        
-        if should_change_name:
-            while name in names:
-                name = f"{stem}.{counter:03d}"
-                counter += 1
+        if names[name] > 1:
+            names[name] -= 1
+            name = MaskNameIndex(names).unique_name(name)
 
         return name
 
@@ -140,6 +283,18 @@ class EMPMaskLayer(PropertyGroup):
         description="Include all objects parented to this object as a part of the selection"
         )
 
+    backend : EnumProperty(
+        name="Backend",
+        default="DEFAULT",
+        description="How the mask is separated from the render",
+        items=(
+            ("DEFAULT", "Default", "Use the backend chosen in the mask render settings"),
+            ("CRYPTOMATTE", "Cryptomatte", "Use a cryptomatte pass"),
+            ("PASS_INDEX", "Pass Index", "Give the selection a temporary pass index and use the Object/Material Index pass, which is cheaper for large numbers of masks. (Cycles only)"),
+            ),
+        options=set()
+        )
+
     selection_type : EnumProperty(
         name="Selection Type",
         default="OBJECT",
@@ -154,6 +309,10 @@ class EMPMaskLayer(PropertyGroup):
     selection_object : PointerProperty(name="Selection", type=bpy.types.Object)
     selection_material : PointerProperty(name="Selection", type=bpy.types.Material)
     selection_collection : PointerProperty(name="Selection", type=bpy.types.Collection)
+    output_format : PointerProperty(name="Output Format", type=EMPOutputFormat)
+
+    def slot_format(self, mask_type):
+        return self.output_format.slot_format("Alpha Mask" if mask_type == "ALPHA" else "Mask")
 
     def initialize_name(self):
         self.name = self.name
@@ -169,83 +328,6 @@ class EMPMaskLayer(PropertyGroup):
         else:
             return bpy.context.scene.view_layers[0].name
 
-    @property
-    def solo_objects(self):
-        if self.selection_type == "OBJECT":
-            obj = self.selection_object
-            yield obj
-
-            if obj and self.obj_include_children:
-                for child in obj.children_recursive:
-                    yield child
-
-        elif self.selection_type == "MATERIAL":
-            material = self.selection_material
-            if material is not None:
-                user_map = bpy.data.user_map(subset=(material,))
-                material_users = user_map[material]
-                for obj in bpy.context.scene.collection.all_objects:
-                    if obj.data in material_users:
-                        yield obj
-
-        elif self.selection_type == "COLLECTION":
-            col = self.selection_collection
-            if col is None:
-                yield None
-            else:
-                for obj in col.all_objects:
-                    yield obj
-
-    def layer_name(self, view_layer_name):
-        selection_type = self.selection_type
-        if selection_type == "OBJECT":
-            return f"{view_layer_name}.CryptoObject"
-        elif selection_type == "MATERIAL":
-            return f"{view_layer_name}.CryptoMaterial"
-        elif selection_type == "COLLECTION":
-            return f"{view_layer_name}.CryptoObject"
-        else:
-            raise ValueError
-
-    @property
-    def matte_id(self):
-        selection_type = self.selection_type
-        if selection_type == "OBJECT":
-            obj = self.selection_object
-            if obj is None:
-                return ""
-
-            if self.obj_include_children:
-                objects = (obj, *(obj.children_recursive))
-                return ", ".join((o.name for o in objects))
-            else:
-                return self.selection_object.name
-            
-        elif selection_type == "MATERIAL":
-            mat = self.selection_material
-            if mat is None:
-                return ""
-            
-            return mat.name
-        
-        elif selection_type == "COLLECTION":
-            col = self.selection_collection
-            if col is None:
-                return ""
-            
-            return ", ".join((o.name for o in col.all_objects))
-        
-        else:
-            raise ValueError
-
-    def enable_pass(self, view_layer):
-        if self.selection_type in {"OBJECT", "COLLECTION"}:
-            view_layer.use_pass_cryptomatte_object = True
-        elif self.selection_type == "MATERIAL":
-            view_layer.use_pass_cryptomatte_material = True
-        else:
-            raise ValueError
-
     def draw(self, layout):
         layout.prop(self, "name")
         ui_draw_enum_prop(layout, self, "selection_type")
@@ -265,6 +347,23 @@ class EMPMaskLayer(PropertyGroup):
         col.prop(self, "invert")
         col.prop(self, "solo")
 
+        col = layout.column()
+        col.active = not self.solo
+        col.prop(self, "backend")
+
+        header, panel = layout.panel("EMP_PT_MASK_OUTPUT_FORMAT", default_closed=True)
+        header.label(text="Output Format")
+        if panel:
+            panel.use_property_split = True
+            data = get_addon_properties()
+            is_packed = data.mask_type == "BLACK_AND_WHITE" and data.mask_packing != "NONE"
+            if is_packed:
+                panel.label(text="Not used while masks are packed", icon='INFO')
+
+            col = panel.column()
+            col.active = not is_packed
+            self.output_format.draw(col, "Alpha Mask" if data.mask_type == "ALPHA" else "Mask")
+
 
 class EasyMCPassesDirectionMasks(PropertyGroup):
     pos_x : BoolProperty(name="+X", default=True, options=set())
@@ -318,35 +417,95 @@ class EasyMCPassesDirectionMasks(PropertyGroup):
             if getattr(self, prop_name):
                 yield prop_name
 
-    def create_outputs(self, slots, is_exr):
+    def create_outputs(self, builder, output_node, is_exr, slot_format=None):
         for prop_name in self.enabled_masks:
             slot_name = self.output_name(prop_name, is_exr=is_exr)
-            slots.new(slot_name)
 
-            slot = slots[slot_name]
-            slot.use_node_format = False
-            slot.format.file_format = 'PNG'
-            slot.format.color_mode = 'RGBA'
+            if is_exr:
+                builder.add_slot(output_node, slot_name)
+            else:
+                builder.add_slot(output_node, slot_name, **slot_format)
 
-    def link_sockets(self, tree, output_node, is_exr):
+    def link_sockets(self, builder, output_node, is_exr):
         for prop_name in self.enabled_masks:
-            math_node = tree.nodes[self.output_name(prop_name, is_exr=False)]
-            tree.links.new(math_node.outputs["Value"], output_node.inputs[self.output_name(prop_name, is_exr=is_exr)])
-
-    def add_nodes(self, tree, start_location):
-        sep_xyz = tree.nodes["EMP_DirMaskXYZ"]
+            math_node = self.output_name(prop_name, is_exr=False)
+            builder.link(math_node, "Value", output_node, self.output_name(prop_name, is_exr=is_exr))
 
+    def add_nodes(self, builder, start_location):
         for i, prop_name in enumerate(self.enabled_masks):
             location = (start_location[0], start_location[1] - i*45)
             name = self.output_name(prop_name, is_exr=False)
-            math_node = add_node(tree, node_type="CompositorNodeMath", name=name, label=name, operation="MULTIPLY", location=location)
-            math_node.hide = True
 
             value = 1 if prop_name.startswith("pos") else -1
-            math_node.inputs[1].default_value = value
+            builder.add_node("CompositorNodeMath", name=name, label=name, operation="MULTIPLY", location=location, hide=True,
+                inputs=((1, value),))
 
             target_socket = prop_name[-1].upper()
-            tree.links.new(sep_xyz.outputs[target_socket], math_node.inputs[0])
+            builder.link("EMP_DirMaskXYZ", target_socket, name, 0)
+
+
+class EMPExportJob(PropertyGroup):
+    name: StringProperty(name="Name", default="Job")
+    camera: PointerProperty(name="Camera", type=bpy.types.Object, poll=lambda self, obj: obj.type == 'CAMERA',
+        description="Camera the job is rendered from"
+        )
+    export_path: StringProperty(name="Export Path", subtype='FILE_PATH',
+        description="Directory where the job's image outputs will be exported to"
+        )
+    enabled_passes: StringProperty(name="Passes", default="[]")
+    enabled_masks: StringProperty(name="Masks", default="[]")
+    status: EnumProperty(
+        name="Status",
+        default="QUEUED",
+        items=(
+            ("QUEUED", "Queued", "", "TIME", 0),
+            ("RUNNING", "Running", "", "RENDER_ANIMATION", 1),
+            ("DONE", "Done", "", "CHECKMARK", 2),
+            ("FAILED", "Failed", "", "ERROR", 3),
+            ),
+        options=set()
+        )
+    message: StringProperty(name="Message")
+
+    @property
+    def pass_names(self):
+        return json.loads(self.enabled_passes)
+
+    @property
+    def mask_names(self):
+        return json.loads(self.enabled_masks)
+
+    def capture(self, scene):
+        props = scene.EMP_Properties
+        self.camera = scene.camera
+        self.export_path = props.export_path
+        self.enabled_passes = json.dumps([i.name for i in props.render_passes if i.render])
+        self.enabled_masks = json.dumps([i.name for i in props.mask_layers if i.render])
+
+    def apply(self, scene):
+        props = scene.EMP_Properties
+        if self.camera is not None:
+            scene.camera = self.camera
+        props.export_path = self.export_path
+
+        pass_names = set(self.pass_names)
+        for render_pass in props.render_passes:
+            render_pass.render = render_pass.name in pass_names
+
+        mask_names = set(self.mask_names)
+        for mask in props.mask_layers:
+            mask.render = mask.name in mask_names
+
+    def draw(self, layout):
+        layout.prop(self, "name")
+        ui_draw_enum_prop(layout, self, "camera")
+        layout.prop(self, "export_path")
+
+        col = layout.column(align=True)
+        col.label(text=f"Passes: {', '.join(self.pass_names) or 'None'}")
+        col.label(text=f"Masks: {', '.join(self.mask_names) or 'None'}")
+        if self.message:
+            col.label(text=self.message, icon="ERROR" if self.status == "FAILED" else "INFO")
 
 
 class EasyMCPassesProperties(PropertyGroup):
@@ -374,6 +533,31 @@ class EasyMCPassesProperties(PropertyGroup):
         options=set()
         )
     
+    cryptomatte_source: EnumProperty(
+        name="Cryptomatte Source",
+        default="SCENE_COPY",
+        description="Where the cryptomatte passes of non-solo masks are rendered",
+        items=(
+            ("SCENE_COPY", "Separate Render", "Render the cryptomattes in a copy of the scene, using the mask engine and samples"),
+            ("MAIN", "Main Render", "Add the cryptomatte passes to the main render, saving a full extra render of the scene. (Depth of field stays enabled in EEVEE, which can blur the masks.)"),
+            ),
+        options=set()
+        )
+
+    mask_backend: EnumProperty(
+        name="Mask Backend",
+        default="CRYPTOMATTE",
+        description="How non-solo masks are separated from the render, unless a mask overrides it",
+        items=(
+            ("CRYPTOMATTE", "Cryptomatte", "Decode the masks from cryptomatte passes"),
+            ("PASS_INDEX", "Pass Index", "Give each selection a temporary pass index and use ID Mask nodes on the Object/Material Index passes. (Cycles only, other engines fall back to cryptomatte)"),
+            ),
+        options=set()
+        )
+    batch_solo_masks : BoolProperty(name="Batch Solo Masks", default=False, options=set(),
+        description="Render solo masks whose bounding boxes cover separate parts of the camera view in a single view layer and separate them with cryptomatte, instead of one render per mask. Not used for frame ranges. (Batched masks can still cast shadows and reflections onto each other.)"
+        )
+
     mask_eevee_samples : IntProperty(name="Samples", min=1, default=16, options=set(),
         description="Number of samples per pixel for rendering"                             
         )
@@ -384,9 +568,80 @@ class EasyMCPassesProperties(PropertyGroup):
     export_path : StringProperty(name="Export Path", subtype='FILE_PATH',
         description="Directory where the various image outputs will be exported to"
         )
+    shading_strategy: EnumProperty(
+        name="Strategy",
+        default="SCENE_COPY",
+        description="How the Shading & Shadow passes are rendered",
+        items=(
+            ("SCENE_COPY", "Separate Render", "Render the passes in a copy of the scene with a blank material override"),
+            ("LIGHTGROUPS", "Main Render Lightgroups", "Add the lights to lightgroups of the main render, which avoids a second render but keeps the scene's own materials. (Cycles only, with denoising off)"),
+            ),
+        options=set()
+        )
+    cavity_source: EnumProperty(
+        name="Cavity Source",
+        default="WORKBENCH",
+        description="How the Cavity pass is made",
+        items=(
+            ("WORKBENCH", "Workbench", "Render the cavity in a Workbench copy of the scene, for the best quality"),
+            ("COMPOSITOR", "Normal Pass", "Compute the cavity from the Normal pass in the compositor, without rendering anything else"),
+            ),
+        options=set()
+        )
+    cavity_ridge_factor : FloatProperty(name="Ridge", default=2.0, min=0.0, max=2.0, options=set(),
+        description="Factor for the highlights on convex edges"
+        )
+    cavity_valley_factor : FloatProperty(name="Valley", default=0.0, min=0.0, max=2.0, options=set(),
+        description="Factor for the shadows in concave edges"
+        )
+    cavity_radius : IntProperty(name="Radius", default=2, min=1, max=32, subtype='PIXEL', options=set(),
+        description="Distance in pixels over which the compositor cavity compares normals"
+        )
+
+    shading_source: EnumProperty(
+        name="Shading Source",
+        default="RENDER",
+        description="How the Shading pass is made",
+        items=(
+            ("RENDER", "Render", "Render the Shading pass with a sun light, like the Shadow pass"),
+            ("NORMAL", "Normal Pass", "Compute the Shading pass from the Normal pass in the compositor, without rendering anything else"),
+            ),
+        options=set()
+        )
     light_direction : FloatVectorProperty(name="Light Direction", subtype="EULER", precision=5, step=100,
         description="The direction of the lighting calculated in Shading & Shadow passes"
         )
+    extra_light_directions : CollectionProperty(name="Extra Light Directions", type=EMPLightDirection,
+        description="Additional light directions, each exported as its own Shading & Shadow outputs from the same render"
+        )
+    active_light_direction_index : IntProperty(name="Active Index", min=0)
+
+    use_frame_range : BoolProperty(name="Frame Range", default=False, options=set(),
+        description="Export every frame of a frame range instead of only the current frame"
+        )
+    frame_start : IntProperty(name="Start", default=1, options=set(),
+        description="First frame of the exported frame range"
+        )
+    frame_end : IntProperty(name="End", default=250, options=set(),
+        description="Final frame of the exported frame range"
+        )
+    frame_step : IntProperty(name="Step", default=1, min=1, options=set(),
+        description="Number of frames to skip forward while exporting the frame range"
+        )
+
+    data_pass_samples : IntProperty(name="Data Pass Samples", default=1, min=0, options=set(),
+        description="Samples used to render data passes (Normal, Mist, Direction Masks) in a view layer of their own, when no other pass needs the main render. (0 always renders them along with the other passes.)"
+        )
+
+    preview_resolution_percentage : IntProperty(name="Resolution", subtype='PERCENTAGE', default=25, min=1, max=100, options=set(),
+        description="Percentage of the render resolution used by preview exports"
+        )
+    preview_max_samples : IntProperty(name="Max Samples", default=16, min=0, options=set(),
+        description="Highest number of samples any scene renders with during preview exports, which also disable denoising. (0 keeps the scenes' own samples.)"
+        )
+    preview_subfolder : StringProperty(name="Subfolder", default="preview/", options=set(),
+        description="Folder inside the export path that preview exports are written to"
+        )
 
     mask_type: EnumProperty(
         name="Mask Type",
@@ -398,9 +653,26 @@ class EasyMCPassesProperties(PropertyGroup):
             ),
         options=set()
         )
+    mask_packing: EnumProperty(
+        name="Pack Masks",
+        default="NONE",
+        description="Combine black & white masks into the channels of shared images, listed in a Masks.json file next to them. The masks' own output formats are not used",
+        items=(
+            ("NONE", "None", "Write every mask to its own image"),
+            ("PNG", "PNG (3 per Image)", "Write 3 masks into the red, green & blue channels of each PNG"),
+            ("OPEN_EXR", "OpenEXR (4 per Image)", "Write 4 masks into the red, green, blue & alpha channels of each EXR"),
+            ),
+        options=set()
+        )
     
     direction_masks : PointerProperty(name="Direction Masks", type=EasyMCPassesDirectionMasks)
 
+    export_jobs : CollectionProperty(name="Export Queue", type=EMPExportJob)
+    active_export_job_index : IntProperty(name="Active Index", min=0)
+    save_queue_progress : BoolProperty(name="Save Progress After Each Job", default=False, options=set(),
+        description="Write the state of the jobs next to the .blend file after every finished job, so that an interrupted queue can be resumed after reopening it"
+        )
+
 
 class EasyMCPassesPreferences(AddonPreferences):
     bl_idname = __package__
@@ -409,15 +681,50 @@ class EasyMCPassesPreferences(AddonPreferences):
     view_passes_after_render : BoolProperty(name="Create EXR for Viewing", default=True,
         description="Create an EXR file with the exported passes that gets viewed after render"
         )
+    viewing_exr_codec : EnumProperty(name="EXR Codec", default="ZIP", items=exr_codec_items,
+        description="Compression of the EXR file created for viewing"
+        )
+    derive_images_from_exr : BoolProperty(name="Write EXR Only", default=False,
+        description="Only write the viewing EXR while rendering, and create the image of each pass from it afterwards in background threads. (Needs Blender's OpenImageIO module, otherwise the images are written while rendering.)"
+        )
     force_render_window : BoolProperty(name="Force Render Window", default=True,
         description="Forces the Render window to appear when rendering. (This avoids crashes when running specific versions of Blender.)"
         )
+    incremental_graph_updates : BoolProperty(name="Incremental Graph Updates", default=False,
+        description="Keep the helper scenes between exports and only patch the parts of the compositor graph that changed"
+        )
+    keep_helper_pool : BoolProperty(name="Keep Helper Scenes", default=False,
+        description="Keep the helper scenes, lights and materials between exports, and only resync them when the source scene's settings change. Use Release Helper Scenes to free them"
+        )
+    use_render_cache : BoolProperty(name="Cache Helper Renders", default=False,
+        description="Render each helper scene to a cached file, and reuse it on the next export if its camera, geometry, materials and render settings did not change"
+        )
+    render_helpers_in_parallel : BoolProperty(name="Render Helper Scenes in Parallel", default=False,
+        description="Render every helper scene at the same time in separate background Blender instances, then combine their results in the compositor"
+        )
+    worker_threads : IntProperty(name="Threads per Instance", default=0, min=0,
+        description="Number of CPU threads used by each background Blender instance. (0 divides the available cores evenly between them.)"
+        )
 
     def draw(self, context):
         layout = self.layout.column()
         layout.prop(self, "default_export_path")
         layout.prop(self, "view_passes_after_render")
+        col = layout.column()
+        col.active = self.view_passes_after_render
+        col.prop(self, "viewing_exr_codec")
+        col.prop(self, "derive_images_from_exr")
         layout.prop(self, "force_render_window")
+        layout.prop(self, "incremental_graph_updates")
+        row = layout.row()
+        row.prop(self, "keep_helper_pool")
+        row.operator("render.emp_release_helper_pool", text="", icon='TRASH')
+        layout.prop(self, "use_render_cache")
+        layout.prop(self, "render_helpers_in_parallel")
+
+        col = layout.column()
+        col.active = self.render_helpers_in_parallel
+        col.prop(self, "worker_threads")
 
         keymap_layout.draw_keyboard_shorcuts(self, layout, context)
 
@@ -428,6 +735,9 @@ keymap_layout.register_properties(preferences=EasyMCPassesPreferences)
 @persistent
 def onFileLoaded(dummy):
     setDefaultCollectionValue()
+    # Left behind when Blender closed in the middle of an export
+    restore_pass_indices()
+    load_queue_progress()
     props = get_addon_properties()
     default_path = fetch_user_preferences("default_export_path")
 
@@ -436,9 +746,12 @@ def onFileLoaded(dummy):
 
 
 classes = (
+    EMPOutputFormat,
     EMPRenderPass,
+    EMPLightDirection,
     EMPMaskLayer,
     EasyMCPassesDirectionMasks,
+    EMPExportJob,
     EasyMCPassesProperties,
     EasyMCPassesPreferences,
     )
@@ -0,0 +1,165 @@
+import bpy
+from bpy.app.handlers import persistent
+
+import dataclasses
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from .plan import NodeSpec, _spec_as_list
+from .scene_state import state_generations
+from .utils import render_scene_to_file
+
+
+# Generations are only comparable within one Blender session,
+# so cached renders never outlive the session that made them
+session_id = uuid.uuid4().hex
+
+role_dependencies = {
+    "MAIN" : ("geometry", "shading"),
+    "SHADING" : ("geometry",),
+    "CAVITY" : ("geometry",),
+    "CRYPTOMATTE" : ("geometry", "shading"),
+    "SOLO" : ("geometry", "shading"),
+}
+
+
+@persistent
+def reset_render_cache(dummy):
+    # Cached renders of the previous file could otherwise match a scene of the same name in this one
+    global session_id
+    session_id = uuid.uuid4().hex
+
+    for key in state_generations:
+        state_generations[key] += 1
+
+    shutil.rmtree(cache_directory(), ignore_errors=True)
+
+
+def cache_directory():
+    return os.path.join(bpy.app.tempdir, "emp_render_cache")
+
+
+def camera_state(camera):
+    if camera is None:
+        return None
+
+    data = camera.data
+    return (
+        camera.name,
+        [tuple(row) for row in camera.matrix_world],
+        data.type, data.lens, data.ortho_scale,
+        data.sensor_fit, data.sensor_width, data.sensor_height,
+        data.shift_x, data.shift_y, data.clip_start, data.clip_end,
+        )
+
+
+def render_state(scene):
+    render = scene.render
+    return (
+        render.engine,
+        render.resolution_x, render.resolution_y, render.resolution_percentage,
+        render.pixel_aspect_x, render.pixel_aspect_y, render.film_transparent,
+        scene.cycles.samples, scene.eevee.taa_render_samples,
+        scene.frame_current,
+        )
+
+
+def scene_fingerprint(base_scene, spec, profile=None):
+    data = {
+        "session" : session_id,
+        "spec" : _spec_as_list(spec),
+        "profile" : None if profile is None else _spec_as_list(profile),
+        "camera" : camera_state(base_scene.camera),
+        "render" : render_state(base_scene),
+        "generations" : [state_generations[i] for i in role_dependencies[spec.role]],
+    }
+
+    data = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_path(scene_name, fingerprint):
+    return os.path.join(cache_directory(), f"EMP_Cache_{scene_name}_{fingerprint}.exr")
+
+
+def cached_node(spec, scene_paths, scene_layers):
+    props = dict(spec.props)
+    scene_name = props.get("scene")
+
+    if scene_name not in scene_paths:
+        return spec
+
+    path = scene_paths[scene_name]
+
+    if spec.node_type == "CompositorNodeRLayers":
+        layer = props.pop("layer", scene_layers[scene_name])
+        del props["scene"]
+        return NodeSpec(spec.name, "CompositorNodeImage", (*props.items(), ("image", path), ("layer", layer)), spec.inputs)
+
+    elif spec.node_type == "CompositorNodeCryptomatteV2":
+        cached_props = [("source", "IMAGE"), ("image", path)]
+        cached_props.extend((k, v) for k, v in props.items() if k != "scene")
+        return NodeSpec(spec.name, spec.node_type, tuple(cached_props), spec.inputs)
+
+    return spec
+
+
+def use_cached_renders(plan, base_scene, reuse=True):
+    # Points every node of the plan at the cached render of its scene,
+    # and returns the scenes whose cached render is missing or out of date
+    # (or every scene, when reuse is disabled)
+    scene_paths = {}
+    scene_layers = {}
+    pending = []
+
+    for spec in plan.scenes:
+        path = cache_path(spec.name, scene_fingerprint(base_scene, spec, profile=plan.profile))
+        scene_paths[spec.name] = path
+        scene_layers[spec.name] = next(i.name for i in spec.view_layers if i.use)
+
+        if not (reuse and os.path.exists(path)):
+            pending.append((spec, path))
+
+    nodes = tuple(cached_node(spec, scene_paths, scene_layers) for spec in plan.nodes)
+    return dataclasses.replace(plan, nodes=nodes), pending
+
+
+def discard_stale_renders(scene_name, path):
+    images = bpy.data.images
+
+    for stale_path in glob.glob(os.path.join(cache_directory(), f"EMP_Cache_{glob.escape(scene_name)}_*.exr")):
+        if os.path.normpath(stale_path) == os.path.normpath(path):
+            continue
+
+        for img in tuple(images):
+            if os.path.normpath(bpy.path.abspath(img.filepath)) == os.path.normpath(stale_path):
+                images.remove(img)
+
+        os.remove(stale_path)
+
+
+def render_pending_scenes(pending):
+    os.makedirs(cache_directory(), exist_ok=True)
+    render_times = {}
+
+    for spec, path in pending:
+        start_time = time.monotonic()
+        render_scene_to_file(bpy.data.scenes[spec.name], path)
+        render_times[spec.name] = time.monotonic() - start_time
+
+        discard_stale_renders(spec.name, path)
+
+    return render_times
+
+
+def register():
+    bpy.app.handlers.load_post.append(reset_render_cache)
+
+
+def unregister():
+    bpy.app.handlers.load_post.remove(reset_render_cache)
@@ -0,0 +1,51 @@
+import bpy
+from bpy.app.handlers import persistent
+
+
+# Bumped whenever the data a render depends on changes, so that anything computed from it can tell it is out of date
+state_generations = {"geometry" : 0, "shading" : 0}
+# Pointers of IDs whose next update comes from the export itself, like a temporary pass index
+ignored_updates = set()
+
+shading_types = (
+    bpy.types.Material,
+    bpy.types.World,
+    bpy.types.Light,
+    bpy.types.NodeTree,
+    bpy.types.Image,
+    bpy.types.Texture,
+    )
+
+
+@persistent
+def track_scene_changes(scene, depsgraph):
+    for update in depsgraph.updates:
+        id_data = update.id
+
+        if isinstance(id_data, bpy.types.Scene) or id_data.name.startswith("EMP_"):
+            continue
+
+        pointer = id_data.original.as_pointer()
+        if pointer in ignored_updates:
+            ignored_updates.discard(pointer)
+            continue
+
+        if isinstance(id_data, shading_types):
+            state_generations["shading"] += 1
+        elif isinstance(id_data, bpy.types.Object):
+            if update.is_updated_geometry or update.is_updated_transform:
+                state_generations["geometry"] += 1
+        else:
+            state_generations["geometry"] += 1
+
+
+def ignore_update(id_data):
+    ignored_updates.add(id_data.as_pointer())
+
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(track_scene_changes)
+
+
+def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(track_scene_changes)
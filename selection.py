@@ -0,0 +1,156 @@
+import bpy
+
+
+class SelectionIndex:
+    # Lookups shared by every mask of an export, each built once on first use
+    # instead of scanning the scene again for every mask
+    def __init__(self, scene):
+        self.scene = scene
+        self._children = None
+        self._material_objects = None
+        self._collection_objects = {}
+
+    @property
+    def scene_objects(self):
+        return self.scene.collection.all_objects
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = {}
+            for obj in self.scene_objects:
+                if obj.parent is not None:
+                    self._children.setdefault(obj.parent.name, []).append(obj)
+
+        return self._children
+
+    @property
+    def material_objects(self):
+        if self._material_objects is None:
+            self._material_objects = {}
+            for obj in self.scene_objects:
+                materials = set(slot.material.name for slot in obj.material_slots if slot.material is not None)
+                for name in materials:
+                    self._material_objects.setdefault(name, []).append(obj)
+
+        return self._material_objects
+
+    def descendants(self, obj):
+        children = self.children
+        stack = list(children.get(obj.name, ()))
+
+        while stack:
+            child = stack.pop()
+            yield child
+            stack.extend(children.get(child.name, ()))
+
+    def objects_with_material(self, material):
+        return self.material_objects.get(material.name, ())
+
+    def collection_objects(self, collection):
+        objects = self._collection_objects.get(collection.name)
+        if objects is None:
+            objects = self._collection_objects[collection.name] = tuple(collection.all_objects)
+
+        return objects
+
+    def mask_objects(self, mask):
+        selection_type = mask.selection_type
+
+        if selection_type == "OBJECT":
+            obj = mask.selection_object
+            if obj is None:
+                return ()
+
+            return (obj, *self.descendants(obj)) if mask.obj_include_children else (obj,)
+
+        elif selection_type == "MATERIAL":
+            material = mask.selection_material
+            return () if material is None else self.objects_with_material(material)
+
+        elif selection_type == "COLLECTION":
+            col = mask.selection_collection
+            return () if col is None else self.collection_objects(col)
+
+        else:
+            raise ValueError
+
+    def validate(self, masks):
+        warnings = []
+        solo_owners = {}
+
+        for mask in masks:
+            objects = self.mask_objects(mask)
+            if len(objects) == 0:
+                warnings.append(f"Mask \"{mask.name}\" does not select any object in the scene")
+
+            if mask.solo:
+                for obj in objects:
+                    if obj.name in solo_owners:
+                        warnings.append(f"Solo masks \"{solo_owners[obj.name]}\" and \"{mask.name}\" both select \"{obj.name}\"")
+                        break
+                    solo_owners[obj.name] = mask.name
+
+        return tuple(warnings)
+
+
+def root_parent(obj):
+    while obj.parent is not None:
+        obj = obj.parent
+
+    return obj
+
+
+def compact_selection(objects, index):
+    # The cryptomatte asset layer identifies every object by the root of its hierarchy,
+    # so a selection made of whole hierarchies only needs the names of their roots
+    objects = set(objects)
+    hierarchies = {}
+
+    for obj in objects:
+        hierarchies.setdefault(root_parent(obj), []).append(obj)
+
+    for root, members in hierarchies.items():
+        if root not in objects or len(members) != sum(1 for _ in index.descendants(root)) + 1:
+            return "CryptoObject", ", ".join(sorted(obj.name for obj in objects))
+
+    return "CryptoAsset", ", ".join(sorted(root.name for root in hierarchies))
+
+
+def object_matte(obj, include_children, index):
+    if not include_children:
+        return "CryptoObject", obj.name
+
+    # A root object and its children form exactly one asset, without listing any of them
+    if obj.parent is None:
+        return "CryptoAsset", obj.name
+
+    return "CryptoObject", ", ".join((obj.name, *(o.name for o in index.descendants(obj))))
+
+
+def matte_selection(mask, index=None):
+    # Returns the cryptomatte pass & matte ID that pick out the mask's selection
+    selection_type = mask.selection_type
+    if index is None:
+        index = SelectionIndex(bpy.context.scene)
+
+    if selection_type == "OBJECT":
+        obj = mask.selection_object
+        if obj is None:
+            return "CryptoObject", ""
+
+        return object_matte(obj, mask.obj_include_children, index)
+
+    elif selection_type == "MATERIAL":
+        mat = mask.selection_material
+        return "CryptoMaterial", "" if mat is None else mat.name
+
+    elif selection_type == "COLLECTION":
+        col = mask.selection_collection
+        if col is None:
+            return "CryptoObject", ""
+
+        return compact_selection(index.collection_objects(col), index)
+
+    else:
+        raise ValueError
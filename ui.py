@@ -1,7 +1,19 @@
 import bpy
 from bpy.types import Operator, Panel, UIList
 
-from .operators import EMP_OT_EXPORT_PASSES, EMP_OT_OPEN_FILE_EXPLORER
+from . import export_job
+from .operators import (
+    EMP_OT_ADD_EXPORT_JOB,
+    EMP_OT_CANCEL_EXPORT,
+    EMP_OT_EXPORT_PASSES,
+    EMP_OT_OPEN_FILE_EXPLORER,
+    EMP_OT_PREVIEW_EXPORT_PLAN,
+    EMP_OT_REMOVE_EXPORT_JOB,
+    EMP_OT_RESET_EXPORT_QUEUE,
+    EMP_OT_RUN_EXPORT_QUEUE,
+    EMP_OT_UPDATE_EXPORT_JOB,
+    )
+from .prefs import MaskNameIndex
 from .utils import get_addon_property, get_addon_properties, ui_draw_enum_prop
 
 
@@ -108,8 +120,75 @@ class EMP_PT_EXPORT_PASSES(Panel):
         data = get_addon_properties()
         
         layout.prop(data, "export_path", text="", placeholder="Export Path")
-        layout.operator(EMP_OT_EXPORT_PASSES.bl_idname)
+
+        header, panel = layout.panel("EMP_PT_EXPORT_FRAME_RANGE", default_closed=True)
+        header.prop(data, "use_frame_range")
+        if panel:
+            col = panel.column(align=True)
+            col.active = data.use_frame_range
+            col.prop(data, "frame_start")
+            col.prop(data, "frame_end")
+            col.prop(data, "frame_step")
+
+        header, panel = layout.panel("EMP_PT_EXPORT_PREVIEW", default_closed=True)
+        header.label(text="Preview Settings")
+        if panel:
+            col = panel.column(align=True)
+            col.prop(data, "preview_resolution_percentage")
+            col.prop(data, "preview_max_samples")
+            col.prop(data, "preview_subfolder")
+
+        self.draw_queue(layout, data)
+
+        if job := export_job.active_job:
+            self.draw_progress(layout, job, queue=export_job.active_queue)
+        elif export_job.active_queue is not None:
+            layout.operator(EMP_OT_CANCEL_EXPORT.bl_idname, icon="CANCEL")
+        else:
+            row = layout.row(align=True)
+            row.operator(EMP_OT_EXPORT_PASSES.bl_idname).profile = "FINAL"
+            row.operator(EMP_OT_EXPORT_PASSES.bl_idname, text="Preview", icon="HIDE_OFF").profile = "PREVIEW"
+            row.operator(EMP_OT_PREVIEW_EXPORT_PLAN.bl_idname, text="", icon="TEXT")
+
         layout.operator(EMP_OT_OPEN_FILE_EXPLORER.bl_idname, icon="FOLDER_REDIRECT")
+
+    @staticmethod
+    def draw_queue(layout, data):
+        header, panel = layout.panel("EMP_PT_EXPORT_QUEUE", default_closed=True)
+        header.label(text=f"Queue ({len(data.export_jobs)})")
+        if not panel:
+            return
+
+        row = panel.row()
+        row.template_list("EMP_PT_UL_EXPORT_JOBS", "", data, "export_jobs", data, "active_export_job_index", rows=3)
+
+        ops_col = row.column(align=True)
+        ops_col.operator(EMP_OT_ADD_EXPORT_JOB.bl_idname, icon='ADD', text="")
+        ops_col.operator(EMP_OT_REMOVE_EXPORT_JOB.bl_idname, icon='REMOVE', text="")
+        ops_col.separator()
+        ops_col.operator(EMP_OT_UPDATE_EXPORT_JOB.bl_idname, icon='FILE_REFRESH', text="")
+
+        try:
+            data.export_jobs[data.active_export_job_index].draw(panel.column())
+        except IndexError:
+            pass
+
+        panel.prop(data, "save_queue_progress")
+
+        row = panel.row(align=True)
+        row.operator(EMP_OT_RUN_EXPORT_QUEUE.bl_idname, icon="SEQUENCE")
+        row.operator(EMP_OT_RESET_EXPORT_QUEUE.bl_idname, text="", icon="LOOP_BACK")
+
+    @staticmethod
+    def draw_progress(layout, job, queue=None):
+        box = layout.box()
+        col = box.column(align=True)
+        if queue is not None:
+            col.label(text=queue.status, icon="SEQUENCE")
+        col.label(text=job.render_layer or job.status, icon="RENDER_STILL")
+        col.progress(factor=job.progress, type='BAR', text=f"{job.progress:.0%}")
+        col.label(text=job.summary)
+        box.operator(EMP_OT_CANCEL_EXPORT.bl_idname, icon="CANCEL")
         
 
 class EMP_PT_UL_PASSES(UIList):
@@ -126,6 +205,30 @@ class EMP_PT_UL_PASSES(UIList):
             layout.label(text="")
 
 
+class EMP_PT_UL_EXPORT_JOBS(UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        if self.layout_type in {'DEFAULT', 'COMPACT'}:
+            row = layout.row(align=True)
+            row.prop(item, "name", text="", emboss=False)
+            row.prop(item, "status", text="", emboss=False, icon_only=True)
+
+        elif self.layout_type in {'GRID'}:
+            layout.alignment = 'CENTER'
+            layout.label(text="")
+
+
+class EMP_PT_UL_LIGHT_DIRECTIONS(UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        if self.layout_type in {'DEFAULT', 'COMPACT'}:
+            row = layout.row(align=True)
+            row.prop(item, "name", text="", emboss=False, icon="LIGHT_SUN")
+            row.prop(item, "direction", text="")
+
+        elif self.layout_type in {'GRID'}:
+            layout.alignment = 'CENTER'
+            layout.label(text="")
+
+
 class EMP_PT_MASK_LAYERS(Panel):
     bl_label = "Masks"
     bl_space_type = 'VIEW_3D'
@@ -150,6 +253,9 @@ class EMP_PT_MASK_LAYERS(Panel):
         props = add_remove_col.operator("my_list.new_item", icon='ADD', text="")
         props = add_remove_col.operator("my_list.delete_item", icon='REMOVE', text="")
 
+        ops_col.separator()
+        ops_col.operator_menu_enum("my_list.new_items_from_selection", "source", icon='RESTRICT_SELECT_OFF', text="")
+
         ops_col.separator()
 
         up_down_col = ops_col.column(align=True)
@@ -170,6 +276,9 @@ class EMP_PT_MASK_LAYERS(Panel):
             panel.use_property_split = True
             data = get_addon_properties()
             col = panel.column()
+            col.prop(data, "cryptomatte_source")
+            col.prop(data, "mask_backend")
+            col.prop(data, "batch_solo_masks")
             col.prop(data, "mask_engine")
             if data.mask_engine == "BLENDER_EEVEE_NEXT":
                 col.prop(data, "mask_eevee_samples")
@@ -178,6 +287,10 @@ class EMP_PT_MASK_LAYERS(Panel):
                 
             col.prop(data, "mask_type")
 
+            sub = col.column()
+            sub.active = data.mask_type == "BLACK_AND_WHITE"
+            sub.prop(data, "mask_packing")
+
 
 class EMP_PT_UL_MASKS(UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
@@ -220,6 +333,78 @@ class EMP_OT_ADD_MASK(Operator):
         return {'FINISHED'}
 
 
+class EMP_OT_ADD_MASKS_FROM_SELECTION(Operator):
+    bl_idname = "my_list.new_items_from_selection"
+    bl_label = "Add Masks from Selection"
+    bl_description = "Add a mask for each of the selected objects, their collections or the active object's materials"
+    bl_options = {"REGISTER", "UNDO"}
+
+    source: bpy.props.EnumProperty(
+        name="Source",
+        items=(
+            ("OBJECT", "Selected Objects", "Add a mask for each selected object", "OBJECT_DATA", 0),
+            ("COLLECTION", "Collections of Selected", "Add a mask for each collection containing a selected object", "OUTLINER_COLLECTION", 1),
+            ("MATERIAL", "Active Object's Materials", "Add a mask for each material of the active object", "MATERIAL_DATA", 2),
+            ),
+        )
+    skip_existing: bpy.props.BoolProperty(name="Skip Existing", default=True,
+        description="Don't add masks for selections that already have one"
+        )
+
+    @classmethod
+    def poll(cls, context):
+        return len(context.selected_objects) > 0 or context.active_object is not None
+
+    def selections(self, context):
+        if self.source == "OBJECT":
+            return list(context.selected_objects)
+
+        elif self.source == "COLLECTION":
+            master_collection = context.scene.collection
+            collections = {}
+            for obj in context.selected_objects:
+                for col in obj.users_collection:
+                    if col != master_collection:
+                        collections.setdefault(col.name, col)
+            return list(collections.values())
+
+        elif self.source == "MATERIAL":
+            obj = context.active_object
+            if obj is None:
+                return []
+            materials = {slot.material.name: slot.material for slot in obj.material_slots if slot.material is not None}
+            return list(materials.values())
+
+        else:
+            raise ValueError
+
+    def execute(self, context):
+        data = get_addon_properties()
+        collection = data.mask_layers
+        selection_prop = f"selection_{self.source.lower()}"
+
+        selections = self.selections(context)
+        if self.skip_existing:
+            existing = set(getattr(i, selection_prop) for i in collection if i.selection_type == self.source)
+            selections = [i for i in selections if i not in existing]
+
+        if len(selections) == 0:
+            self.report({'INFO'}, "No new selections to add masks for")
+            return {'CANCELLED'}
+
+        names = MaskNameIndex(i.name for i in collection)
+        for selection in selections:
+            prop = collection.add()
+            # Assigned through the ID property, since the name's update would rescan the whole collection
+            prop["name"] = names.unique_name(selection.name)
+            prop.selection_type = self.source
+            setattr(prop, selection_prop, selection)
+
+        data.active_mask_index = len(collection) - 1
+        self.report({'INFO'}, f"Added {len(selections)} mask(s)")
+        return {'FINISHED'}
+
+
 class EMP_OT_REMOVE_MASK(Operator): 
     bl_idname = "my_list.delete_item" 
     bl_label = "Remove Mask" 
@@ -241,6 +426,44 @@ class EMP_OT_REMOVE_MASK(Operator):
         return{'FINISHED'}
 
 
+class EMP_OT_ADD_LIGHT_DIRECTION(Operator):
+    bl_idname = "render.emp_add_light_direction"
+    bl_label = "Add Light Direction"
+    bl_description = "Add a light direction to export as extra Shading & Shadow outputs"
+    bl_options = {"REGISTER", "UNDO"}
+
+    def execute(self, context):
+        data = get_addon_properties()
+        collection = data.extra_light_directions
+
+        prop = collection.add()
+        prop.name = f"Light_{len(collection):02d}"
+        prop.direction = data.light_direction
+        data.active_light_direction_index = len(collection) - 1
+
+        return {'FINISHED'}
+
+
+class EMP_OT_REMOVE_LIGHT_DIRECTION(Operator):
+    bl_idname = "render.emp_remove_light_direction"
+    bl_label = "Remove Light Direction"
+    bl_description = "Remove the selected light direction"
+    bl_options = {"REGISTER", "UNDO"}
+
+    @classmethod
+    def poll(cls, context):
+        return len(get_addon_property("extra_light_directions")) > 0
+
+    def execute(self, context):
+        data = get_addon_properties()
+        collection = data.extra_light_directions
+        index = data.active_light_direction_index
+
+        collection.remove(index)
+        data.active_light_direction_index = min(max(0, index - 1), len(collection) - 1)
+        return {'FINISHED'}
+
+
 class EMP_OT_MOVE_MASK(Operator): 
     bl_idname = "my_list.move_item" 
     bl_label = "Move Mask" 
@@ -290,9 +513,14 @@ classes = (
     EMP_PT_EXPORT_PASSES,
     EMP_PT_UL_PASSES,
     EMP_PT_UL_MASKS,
+    EMP_PT_UL_EXPORT_JOBS,
+    EMP_PT_UL_LIGHT_DIRECTIONS,
     EMP_OT_ADD_MASK,
+    EMP_OT_ADD_MASKS_FROM_SELECTION,
     EMP_OT_REMOVE_MASK,
     EMP_OT_MOVE_MASK,
+    EMP_OT_ADD_LIGHT_DIRECTION,
+    EMP_OT_REMOVE_LIGHT_DIRECTION,
 )
 
 
@@ -1,5 +1,11 @@
 import bpy
 
+import hashlib
+import os
+import sys
+
+from .scene_state import ignore_update
+
 
 def fetch_user_preferences(attr_id=None):
     prefs = bpy.context.preferences.addons[__package__].preferences
@@ -27,24 +33,117 @@ def get_addon_property(prop_name, scene=None):
     return getattr(scene.EMP_Properties, prop_name)
 
 
-def clear_helper_datablocks():
-    scenes = bpy.data.scenes
+helper_scene_names = ("EMP_Export_Passes", "EMP_Workbench_Cavity", "EMP_Shading_and_Shadows", "EMP_Cryptomatte", "EMP_Solo_Masks")
 
-    for scene_name in ("EMP_Export_Passes", "EMP_Workbench_Cavity", "EMP_Shading_and_Shadows", "EMP_Cryptomatte", "EMP_Solo_Masks"):
-        if scene_name in scenes:
-            scenes.remove(scenes[scene_name])
 
-    materials = bpy.data.materials    
+# Data collections searched for the datablocks that exports create
+helper_data_collections = ("scenes", "objects", "lights", "materials", "images", "collections", "node_groups", "worlds")
 
-    for mat_name in ("EMP_BlankMaterial",):
-        if mat_name in materials:
-            materials.remove(materials[mat_name])
 
-    collections = bpy.data.collections
+def tag_helper(id_data):
+    id_data["emp_helper"] = True
+    return id_data
+
+
+def displayed_images():
+    images = set()
+
+    for screen in bpy.data.screens:
+        for area in screen.areas:
+            if area.type == 'IMAGE_EDITOR' and area.spaces.active.image is not None:
+                images.add(area.spaces.active.image)
+
+    return images
+
+
+def helper_datablocks(keep=()):
+    for attr in helper_data_collections:
+        for id_data in getattr(bpy.data, attr):
+            if id_data.get("emp_helper") and id_data not in keep:
+                yield id_data
+
+
+def helper_light_data(datablocks):
+    # Light data that only helper light objects use, even if the export didn't make it itself
+    users = {}
+    for obj in datablocks:
+        if isinstance(obj, bpy.types.Object) and obj.type == 'LIGHT':
+            users[obj.data] = users.get(obj.data, 0) + 1
+
+    return set(light for light, count in users.items() if light.users <= count and light.library is None)
+
+
+def process_memory():
+    # Resident memory of Blender in bytes, or None where it can't be read
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+
+    return None
+
+
+def format_memory(size):
+    return "?" if size is None else f"{size / 2**20:.0f} MB"
+
+
+def clear_helper_datablocks(report=None):
+    # Removes every datablock tagged by an export, along with the light data of its light objects.
+    # Images shown in an image editor are kept so the last export stays visible
+    memory_before = process_memory()
+    datablock_count = sum(len(getattr(bpy.data, attr)) for attr in helper_data_collections)
+
+    remove_helper_scenes()
+    keep = displayed_images()
+
+    datablocks = set(helper_datablocks(keep=keep))
+    datablocks |= helper_light_data(datablocks)
+    bpy.data.batch_remove(tuple(datablocks))
 
-    for col in collections:
-        if col.name.startswith("EMP_"):
-            collections.remove(col)
+    removed_count = datablock_count - sum(len(getattr(bpy.data, attr)) for attr in helper_data_collections)
+    if report is not None and removed_count > 0:
+        memory_after = process_memory()
+        report({'INFO'}, f"Removed {removed_count} helper datablock(s), memory {format_memory(memory_before)} -> {format_memory(memory_after)}")
+
+    return removed_count
+
+
+def helper_pool_enabled():
+    prefs = fetch_user_preferences()
+    return prefs.keep_helper_pool or prefs.incremental_graph_updates
+
+
+def remove_helper_scenes(keep=()):
+    scenes = bpy.data.scenes
+
+    for scene_name in helper_scene_names:
+        if scene_name in scenes and scene_name not in keep:
+            scenes.remove(scenes[scene_name])
 
 
 def load_image(name, path, replace_existing=False):
@@ -56,6 +155,18 @@ def load_image(name, path, replace_existing=False):
     img = bpy.data.images.load(path)
     img.name = name
 
+    return tag_helper(img)
+
+
+def load_multilayer_file(path):
+    # An image of the file that was already loaded is reused, but only new ones belong to the export
+    path = os.path.normpath(bpy.path.abspath(path))
+    img = next((i for i in bpy.data.images if i.source == 'FILE' and os.path.normpath(bpy.path.abspath(i.filepath)) == path), None)
+    if img is None:
+        img = tag_helper(bpy.data.images.load(path))
+
+    # Multilayer images only expose their render layers once the file has been read
+    img.size
     return img
 
 
@@ -74,67 +185,9 @@ pass_link_map = {
     "Direction Masks" : ("Main Passes", "Normal"),
 }
 
-
-def link_pass_sockets(tree, render_pass):
-    pass_name = render_pass.name
-    nodes = tree.nodes
-    output_node1 = nodes["File Output (Images)"]
-
-    prefs = fetch_user_preferences()
-    use_exr = prefs.view_passes_after_render
-
-    if use_exr:
-        output_node2 = nodes["File Output (EXR)"]
-
-    if pass_name == "Direction Masks":
-        dir_masks = get_addon_property("direction_masks")
-        if dir_masks.has_outputs:
-            input_node, input_soc = pass_link_map[pass_name]
-            input_node = nodes[input_node]
-            sep_xyz = nodes["EMP_DirMaskXYZ"]
-        
-            tree.links.new(input_node.outputs[input_soc], sep_xyz.inputs["Vector"])
-
-            dir_masks.link_sockets(tree, output_node1, is_exr=False)
-            if use_exr:
-                dir_masks.link_sockets(tree, output_node2, is_exr=True)
-
-    else:
-        input_node, input_soc = pass_link_map[pass_name]
-        input_node = nodes[input_node]
-
-        tree.links.new(input_node.outputs[input_soc], output_node1.inputs[pass_name])
-        if use_exr:
-            tree.links.new(input_node.outputs[input_soc], output_node2.inputs[render_pass.exr_output_name])
-
-
-def link_mask_sockets(tree, mask):
-    nodes = tree.nodes
-    output_node1 = nodes["File Output (Images)"]
-
-    prefs = fetch_user_preferences()
-    use_exr = prefs.view_passes_after_render
-
-    if use_exr:
-        output_node2 = nodes["File Output (EXR)"]
-
-    if get_addon_property("mask_type") == "ALPHA":
-        input_node = tree.nodes[f"Alpha_{mask.name}"]
-        input_soc = "Image"
-
-        combined_soc = tree.nodes["Main Passes"].outputs["Image"]
-        tree.links.new(combined_soc, input_node.inputs[input_soc])
-    else:
-        if not mask.invert:
-            input_node = tree.nodes[mask.name]
-            input_soc = "Alpha" if mask.solo else "Matte"
-        else:
-            input_node = tree.nodes[f"Invert_{mask.name}"]
-            input_soc = 0
-
-    tree.links.new(input_node.outputs[input_soc], output_node1.inputs[mask.name])
-    if use_exr:
-        tree.links.new(input_node.outputs[input_soc], output_node2.inputs[mask.exr_output_name])
+# Passes that hold geometric data rather than lighting,
+# which converge after a handful of samples and get a render layer of their own
+data_passes = {"Mist", "Normal", "Direction Masks"}
 
 
 def get_enabled_passes(collection):
@@ -155,14 +208,232 @@ def get_mask_layers(selection_type=None):
 
 
 def add_node(tree, node_type, *_, **props):
-    node = tree.nodes.new(node_type)
+    # Named nodes are reused when they already exist, so that rebuilding a graph
+    # only touches the nodes that actually changed
+    node = tree.nodes.get(props.get("name", ""))
+
+    if node is not None and node.bl_idname != node_type:
+        tree.nodes.remove(node)
+        node = None
+
+    if node is None:
+        node = tree.nodes.new(node_type)
 
     for prop, value in props.items():
         setattr(node, prop, value)
 
+    node["emp_build"] = tree.get("emp_build", 0)
     return node
 
 
+def begin_graph_build(tree):
+    tree["emp_build"] = tree.get("emp_build", 0) + 1
+
+
+def prune_graph(tree):
+    # Remove every node that was not added/reused since the last begin_graph_build()
+    build = tree.get("emp_build", 0)
+    nodes = tree.nodes
+
+    for node in tuple(nodes):
+        if node.get("emp_build") != build:
+            nodes.remove(node)
+
+
+def link_sockets(tree, output_socket, input_socket):
+    for link in input_socket.links:
+        if link.from_socket == output_socket:
+            return link
+
+    return tree.links.new(output_socket, input_socket)
+
+
+def prune_links(tree, keep):
+    # Remove links of reused nodes that the rebuilt graph no longer has
+    links = tree.links
+    keep = set(i.as_pointer() for i in keep)
+
+    for link in tuple(links):
+        if link.as_pointer() not in keep:
+            links.remove(link)
+
+
+def ensure_file_slot(slots, name):
+    if name not in slots:
+        slots.new(name)
+
+    return slots[name]
+
+
+def prune_file_slots(node, keep):
+    slots = node.file_slots
+
+    for socket in tuple(node.inputs):
+        if socket.name not in keep:
+            slots.remove(socket)
+
+
+def sync_scene_settings(base_scene, scene):
+    scene.camera = base_scene.camera
+    scene.world = base_scene.world
+    scene.frame_current = base_scene.frame_current
+
+    render, base_render = scene.render, base_scene.render
+    for attr in ("engine", "resolution_x", "resolution_y", "resolution_percentage", "pixel_aspect_x", "pixel_aspect_y", "film_transparent", "use_persistent_data"):
+        setattr(render, attr, getattr(base_render, attr))
+
+    scene.cycles.samples = base_scene.cycles.samples
+    scene.cycles.use_denoising = base_scene.cycles.use_denoising
+    scene.eevee.taa_render_samples = base_scene.eevee.taa_render_samples
+    scene.display.render_aa = base_scene.display.render_aa
+
+    for view_layer in scene.view_layers:
+        if base_view_layer := base_scene.view_layers.get(view_layer.name):
+            sync_layer_collections(base_view_layer.layer_collection, view_layer.layer_collection)
+
+    view, base_view = scene.view_settings, base_scene.view_settings
+    scene.display_settings.display_device = base_scene.display_settings.display_device
+    for attr in ("view_transform", "look", "exposure", "gamma"):
+        setattr(view, attr, getattr(base_view, attr))
+
+
+def rna_values(data):
+    values = []
+
+    for prop in data.bl_rna.properties:
+        if prop.type in {'POINTER', 'COLLECTION'} or prop.identifier == "rna_type":
+            continue
+
+        value = getattr(data, prop.identifier, None)
+        if isinstance(value, set):
+            value = tuple(sorted(value))
+        elif hasattr(value, "__len__") and not isinstance(value, str):
+            value = tuple(value)
+        values.append((prop.identifier, value))
+
+    return values
+
+
+def layer_collection_values(layer_col):
+    values = []
+    stack = [layer_col]
+
+    while stack:
+        layer_col = stack.pop()
+        values.append((layer_col.name, layer_col.exclude, layer_col.holdout, layer_col.indirect_only))
+        stack.extend(layer_col.children)
+
+    return values
+
+
+def scene_settings_signature(base_scene):
+    # Covers the source scene's settings as a whole (apart from the camera, world, current frame & color management,
+    # which sync_scene_settings copies), so a helper copy is made again whenever any of them changes
+    settings = [
+        sorted(obj.name for obj in base_scene.collection.objects),
+        sorted(col.name for col in base_scene.collection.children),
+        ]
+
+    for data in (base_scene.render, base_scene.cycles, base_scene.eevee, base_scene.display):
+        settings.append(rna_values(data))
+
+    for view_layer in base_scene.view_layers:
+        settings.append(view_layer.name)
+        settings.append(rna_values(view_layer))
+        settings.append(rna_values(view_layer.cycles))
+        settings.append(view_layer.material_override and view_layer.material_override.name)
+        settings.append(sorted(i.name for i in view_layer.lightgroups))
+        settings.append(layer_collection_values(view_layer.layer_collection))
+
+    return hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+
+
+def sync_layer_collections(base_layer_col, layer_col):
+    for child in layer_col.children:
+        if base_child := base_layer_col.children.get(child.name):
+            child.exclude = base_child.exclude
+            child.holdout = base_child.holdout
+            child.indirect_only = base_child.indirect_only
+            sync_layer_collections(base_child, child)
+
+
+workbench_aa_samples = (("32", 32), ("16", 16), ("11", 11), ("8", 8), ("5", 5), ("FXAA", 1))
+
+
+def apply_preview_settings(scene, resolution_percentage, max_samples):
+    render = scene.render
+    render.resolution_percentage = max(1, render.resolution_percentage * resolution_percentage // 100)
+
+    scene.cycles.use_denoising = False
+
+    if max_samples > 0:
+        scene.cycles.samples = min(scene.cycles.samples, max_samples)
+        scene.eevee.taa_render_samples = min(scene.eevee.taa_render_samples, max_samples)
+
+        aa_samples = dict(workbench_aa_samples).get(scene.display.render_aa, 0)
+        if aa_samples > max_samples:
+            scene.display.render_aa = next(i for i, samples in workbench_aa_samples if samples <= max_samples or i == "FXAA")
+
+
+def blank_render_scene(scene):
+    # Reduces the scene's own render to an empty Workbench frame,
+    # for when every pass it provides is read back from a file instead
+    scene.render.engine = 'BLENDER_WORKBENCH'
+    scene.display.render_aa = 'OFF'
+
+    for view_layer in scene.view_layers:
+        for layer_col in view_layer.layer_collection.children:
+            layer_col.exclude = True
+
+
+def prepare_file_render(scene):
+    # Renders of the scene itself are stored as multilayer EXRs that keep every pass
+    render = scene.render
+    render.use_compositing = False
+
+    image_settings = render.image_settings
+    image_settings.file_format = 'OPEN_EXR_MULTILAYER'
+    image_settings.color_depth = '32'
+    image_settings.exr_codec = 'ZIP'
+
+
+def get_render_result():
+    for img in bpy.data.images:
+        if img.type == 'RENDER_RESULT':
+            return img
+
+
+def render_scene_to_file(scene, path):
+    use_compositing = scene.render.use_compositing
+    prepare_file_render(scene)
+
+    bpy.ops.render.render(scene=scene.name)
+    get_render_result().save_render(path, scene=scene)
+
+    scene.render.use_compositing = use_compositing
+
+
+def ensure_scene(base_scene=None, name="Scene"):
+    # Helper scenes are reused as long as they were copied from the same, unchanged source scene
+    scenes = bpy.data.scenes
+    source_name = "" if base_scene is None else base_scene.name
+    signature = "" if base_scene is None else scene_settings_signature(base_scene)
+
+    scene = scenes.get(name)
+    if scene is not None:
+        if scene.get("emp_source") == source_name and scene.get("emp_sync_signature", "") == signature:
+            if base_scene is not None:
+                sync_scene_settings(base_scene, scene)
+            return scene
+
+        scenes.remove(scene)
+
+    scene = create_scene(base_scene, name, clear_tree=True)
+    scene["emp_source"] = source_name
+    scene["emp_sync_signature"] = signature
+    return scene
+
+
 def create_scene(base_scene=None, name="Scene", clear_tree=False):
 
     if base_scene is not None:
@@ -172,6 +443,7 @@ def create_scene(base_scene=None, name="Scene", clear_tree=False):
     
     new_scene.name = name
     new_scene.use_nodes = True
+    tag_helper(new_scene)
     
     if clear_tree:
         tree = new_scene.node_tree
@@ -180,54 +452,21 @@ def create_scene(base_scene=None, name="Scene", clear_tree=False):
     return new_scene
 
 
-def create_file_outputs(node, outputs):
-    slots = node.file_slots
-
-    for output in outputs:
-        name = output.name
-
-        if output.name == "Direction Masks":
-            dir_masks = get_addon_property("direction_masks")
-            dir_masks.create_outputs(slots, is_exr=False)
-        else:
-            slots.new(name)
-
-
-def create_file_masks(node, masks):
-    slots = node.file_slots
-
-    for mask in masks:
-        slots.new(mask.name)
-        slot = slots[mask.name]
-
-        slot.use_node_format = False
-        slot.format.file_format = 'PNG'
-        slot.format.color_mode = 'RGBA'
-
-
-def create_exr_outputs(node, outputs):
-    slots = node.file_slots
-
-    for output in outputs:
-        if output.name == "Direction Masks":
-            dir_masks = get_addon_property("direction_masks")
-            dir_masks.create_outputs(slots, is_exr=True)
-        else:
-            slots.new(output.exr_output_name)
-
-
-def get_multilayer_render_path():
+def get_multilayer_render_path(frame=None):
     scene = bpy.data.scenes["EMP_Export_Passes"]
     output_node = scene.node_tree.nodes["File Output (EXR)"]
     scene.render.filepath = output_node.base_path
     scene.render.image_settings.file_format = "OPEN_EXR_MULTILAYER"
 
-    return scene.render.frame_path(frame=scene.frame_current)
+    if frame is None:
+        frame = scene.frame_current
+
+    return scene.render.frame_path(frame=frame)
 
 
 def create_light(name, type, *_, **props):
     lights = bpy.data.lights
-    light = lights.new(name, type)
+    light = tag_helper(lights.new(name, type))
 
     for prop, value in props.items():
         setattr(light, prop, value)
@@ -235,90 +474,104 @@ def create_light(name, type, *_, **props):
     return light
 
 
+def ensure_light_object(scene, name, type, *_, **props):
+    obj = bpy.data.objects.get(name)
+
+    if obj is None or obj.type != 'LIGHT' or obj.data.type != type:
+        obj = tag_helper(bpy.data.objects.new(name=name, object_data=create_light(name, type)))
+
+    for prop, value in props.items():
+        setattr(obj.data, prop, value)
+
+    if obj.name not in scene.collection.objects:
+        scene.collection.objects.link(obj)
+
+    return obj
+
+
 def create_collection(scene, name):
     collections = bpy.data.collections
 
-    col = collections.new(name)
+    col = tag_helper(collections.new(name))
     scene.collection.children.link(col)
     return col
 
 
-def create_solo_view_layers(scene):
-    mask_view_layers = []
+def ensure_collection(scene, name):
+    col = bpy.data.collections.get(name)
 
-    for mask in get_mask_layers():
-        if mask.solo:
-            col = create_collection(scene, name=mask.view_layer_name)
-            
-            view_layer = scene.view_layers.new(mask.view_layer_name)
-            view_layer.use_pass_combined = True
-            mask_view_layers.append(view_layer)
+    if col is None:
+        return create_collection(scene, name)
 
-            clear_passes(scene.render, view_layer)
+    if col.name not in scene.collection.children:
+        scene.collection.children.link(col)
 
-            for obj in mask.solo_objects:
-                if obj is not None:
-                    col.objects.link(obj)
+    return col
 
-    for view_layer in mask_view_layers:
-        for layer_col in view_layer.layer_collection.children:
-            layer_col.exclude = (layer_col.name != view_layer.name)
 
+def sync_collection_objects(col, objects):
+    objects = set(obj for obj in objects if obj is not None)
 
-def create_matte_masks(cryptomatte_scene, solo_scene, tree, masks, start_location):
-    for i, mask in enumerate(masks):
-        view_layer_name = mask.view_layer_name
-        location = (start_location[0], start_location[1] - i*45)
+    for obj in tuple(col.objects):
+        if obj not in objects:
+            col.objects.unlink(obj)
 
-        if mask.solo:
-            node = add_node(tree, "CompositorNodeRLayers",
-                name=mask.name, label=mask.name, scene=solo_scene, location=location)
-            node.hide = True
-        else:
-            node = add_node(tree, "CompositorNodeCryptomatteV2",
-                name=mask.name, label=mask.name, scene=cryptomatte_scene, location=location)
-            node.hide = True
+    for obj in objects:
+        if obj.name not in col.objects:
+            col.objects.link(obj)
 
-        if mask.invert:
-            invert_node = add_node(tree, "CompositorNodeMath", name=f"Invert_{mask.name}", label="Invert", operation="SUBTRACT", location=location)
-            invert_node.hide = True
-            invert_node.location.x += 260.0
-            invert_node.inputs[0].default_value = 1.0
 
-            sock_name = "Alpha" if mask.solo else "Matte"
-            tree.links.new(node.outputs[sock_name], invert_node.inputs[1])
+def create_solo_view_layers(scene, view_layer_specs):
+    mask_view_layers = []
+    objects = bpy.data.objects
+
+    # The scene's default view layer only holds the camera
+    scene.view_layers[0].use = False
+
+    for spec in view_layer_specs:
+        col = ensure_collection(scene, name=spec.name)
+        
+        view_layer = scene.view_layers.get(spec.name)
+        if view_layer is None:
+            view_layer = scene.view_layers.new(spec.name)
+
+        mask_view_layers.append(view_layer)
+
+        clear_passes(scene.render, view_layer)
+        for pass_name in spec.passes:
+            setattr(view_layer, pass_name_map[pass_name], True)
+
+        sync_collection_objects(col, (objects.get(name) for name in spec.objects))
 
-        if mask.solo:
-            node.layer = mask.view_layer_name
-        else:
-            node.layer_name = mask.layer_name(view_layer_name)
-            node.matte_id = mask.matte_id
+    # Remove layers and collections left over from solo masks that are no longer rendered
+    wanted_names = set(i.name for i in mask_view_layers)
+    for view_layer in tuple(scene.view_layers):
+        if view_layer.name.startswith("EMP_Solo_") and view_layer.name not in wanted_names:
+            scene.view_layers.remove(view_layer)
 
-        if get_addon_property("mask_type") == "ALPHA":
-            set_alpha = add_node(tree, "CompositorNodeSetAlpha", name=f"Alpha_{mask.name}", mode="REPLACE_ALPHA", location=location)
-            set_alpha.hide = True
-            set_alpha.location.x += 420.0
+    for col in tuple(scene.collection.children):
+        if col.name.startswith("EMP_Solo_") and col.name not in wanted_names:
+            bpy.data.collections.remove(col)
+
+    for view_layer in mask_view_layers:
+        for layer_col in view_layer.layer_collection.children:
+            layer_col.exclude = (layer_col.name != view_layer.name)
 
-            if mask.invert:
-                output_soc = invert_node.outputs["Value"]
-            elif mask.solo:
-                output_soc = node.outputs["Alpha"]
-            else:
-                output_soc = node.outputs["Matte"]
 
-            tree.links.new(output_soc, set_alpha.inputs["Alpha"])
+def set_standard_view_settings(view_settings):
+    view_settings.view_transform = 'Standard'
+    view_settings.look = 'None'
+    view_settings.exposure = 0
+    view_settings.gamma = 1
 
 
 def set_standard_view_transform(scene):
     scene.display_settings.display_device = 'sRGB'
-    scene.view_settings.view_transform = 'Standard'
-    scene.view_settings.look = 'None'
-    scene.view_settings.exposure = 0
-    scene.view_settings.gamma = 1
+    set_standard_view_settings(scene.view_settings)
 
 
 def create_blank_material(name):
-    blank_material = bpy.data.materials.new(name)
+    blank_material = tag_helper(bpy.data.materials.new(name))
     blank_material.use_nodes = True
 
     tree = blank_material.node_tree
@@ -368,7 +621,7 @@ def clear_passes(render, view_layer):
         view_layer.cycles.use_pass_shadow_catcher = False
 
 
-def init_cavity_scene(scene):
+def init_cavity_scene(scene, ridge_factor=2.0, valley_factor=0.0):
     render = scene.render
     render.engine = 'BLENDER_WORKBENCH'
     render.use_freestyle = False
@@ -388,8 +641,8 @@ def init_cavity_scene(scene):
 
     shading.show_cavity = True
     shading.cavity_type = 'SCREEN'
-    shading.curvature_ridge_factor = 2.0
-    shading.curvature_valley_factor = 0.0
+    shading.curvature_ridge_factor = ridge_factor
+    shading.curvature_valley_factor = valley_factor
 
     set_standard_view_transform(scene)
 
@@ -416,11 +669,15 @@ pass_name_map = {
     "Transmission Color" : "use_pass_transmission_color",
     "Emission" : "use_pass_emit",
     "Environment" : "use_pass_environment",
-    "Ambient Occlusion" : "use_pass_ambient_occlusion"
+    "Ambient Occlusion" : "use_pass_ambient_occlusion",
+    "CryptoObject" : "use_pass_cryptomatte_object",
+    "CryptoMaterial" : "use_pass_cryptomatte_material",
+    "CryptoAsset" : "use_pass_cryptomatte_asset",
 }
 
-def add_pass(scene, pass_name):
-    view_layer = scene.view_layers[0]
+def add_pass(scene, pass_name, view_layer=None):
+    if view_layer is None:
+        view_layer = scene.view_layers[0]
 
     if pass_name == "Freestyle":
         scene.render.use_freestyle = True
@@ -431,56 +688,100 @@ def add_pass(scene, pass_name):
         dir_masks = get_addon_property("direction_masks")
         if dir_masks.has_outputs:
             setattr(view_layer, pass_name_map["Normal"], True)
-            tree = scene.node_tree
-            add_node(tree, node_type="CompositorNodeSeparateXYZ", name="EMP_DirMaskXYZ", location=(330, 750))
-            dir_masks.add_nodes(tree, start_location=(490, 750))
 
     else:
         setattr(view_layer, pass_name_map[pass_name], True)
 
 
-def init_main_passes_scene(scene, passes):
+def init_main_passes_scene(scene, view_layer_specs, light_directions=None):
     render = scene.render
     #render.engine = 'CYCLES'
     render.use_compositing = True
 
-    view_layer = scene.view_layers[0]
-    clear_passes(render, view_layer)
+    base_view_layer = scene.view_layers[0]
+    view_layers = []
 
-    for pass_name in passes:
-        add_pass(scene, pass_name)
+    for spec in view_layer_specs:
+        view_layer = scene.view_layers.get(spec.name)
+        if view_layer is None:
+            view_layer = scene.view_layers.new(spec.name)
 
+        # Extra layers follow the base layer, which keeps the user's own settings
+        if view_layer != base_view_layer:
+            sync_layer_collections(base_view_layer.layer_collection, view_layer.layer_collection)
+            view_layer.samples = spec.samples
 
-def init_shading_scene(scene):
-    render = scene.render
-    render.engine = 'CYCLES'
+        view_layer.use = spec.use
+        clear_passes(render, view_layer)
+        view_layers.append((view_layer, spec))
 
-    view_layer = scene.view_layers[0]
-    clear_passes(render, view_layer)
-    
-    shading_light_data = create_light(name="EMP_ShadingPass_Light", type='SUN', angle=0, use_shadow=False)
-    shading_light_data.cycles.max_bounces = 0
-    shadow_light_data = create_light(name="EMP_ShadowPass_Light", type='SUN', angle=0)
-    shadow_light_data.cycles.max_bounces = 0
+    for view_layer, spec in view_layers:
+        for pass_name in spec.passes:
+            add_pass(scene, pass_name, view_layer)
 
-    light_direction = get_addon_property("light_direction")
+    wanted_names = set(i.name for i in view_layer_specs)
+    for view_layer in tuple(scene.view_layers):
+        if view_layer.name.startswith("EMP_") and view_layer.name not in wanted_names:
+            scene.view_layers.remove(view_layer)
 
-    objects = bpy.data.objects
-    shading_light = objects.new(name="EMP_ShadingPass_Light", object_data=shading_light_data)
-    shadow_light = objects.new(name="EMP_ShadowPass_Light", object_data=shadow_light_data)
-    shading_light.rotation_euler = light_direction
-    shadow_light.rotation_euler = light_direction
-    scene.collection.objects.link(shading_light)
-    scene.collection.objects.link(shadow_light)
+    # Shading & Shadow passes taken from lightgroups of the main render
+    if light_directions is not None:
+        add_shading_lights(scene, base_view_layer, light_directions)
+    else:
+        remove_shading_lights(scene)
+        remove_shading_lightgroups(base_view_layer)
+
+
+def shading_lightgroup_names(index):
+    suffix = "" if index == 0 else f"_{index:02d}"
+    return f"EMP_ShadingPass{suffix}", f"EMP_ShadowPass{suffix}"
 
+
+def add_shading_lights(scene, view_layer, light_directions):
+    # Every direction gets its own pair of suns & lightgroups, so they all come out of one render
     lightgroups = view_layer.lightgroups
-    shading_light_group = lightgroups.add(name="EMP_ShadingPass")
-    shadow_light_group = lightgroups.add(name="EMP_ShadowPass")
+    light_names = set()
+    lightgroup_names = set()
+
+    for index, light_direction in enumerate(light_directions):
+        for lightgroup_name, use_shadow in zip(shading_lightgroup_names(index), (False, True)):
+            light = ensure_light_object(scene, f"{lightgroup_name}_Light", 'SUN', angle=0, use_shadow=use_shadow)
+            light.data.cycles.max_bounces = 0
+            light.rotation_euler = light_direction
+
+            lightgroup = lightgroups.get(lightgroup_name) or lightgroups.add(name=lightgroup_name)
+            light.lightgroup = lightgroup.name
+            light_names.add(light.name)
+            lightgroup_names.add(lightgroup.name)
 
-    shading_light.lightgroup = shading_light_group.name
-    shadow_light.lightgroup = shadow_light_group.name
+    remove_shading_lights(scene, keep=light_names)
+    remove_shading_lightgroups(view_layer, keep=lightgroup_names)
 
-    blank_material = create_blank_material("EMP_BlankMaterial")
+
+def remove_shading_lights(scene, keep=()):
+    for obj in tuple(scene.collection.objects):
+        if obj.name.startswith(("EMP_ShadingPass", "EMP_ShadowPass")) and obj.name not in keep:
+            scene.collection.objects.unlink(obj)
+
+
+def remove_shading_lightgroups(view_layer, keep=()):
+    # Left over from light directions that were removed, or from an export that was interrupted
+    lightgroups = view_layer.lightgroups
+    for lightgroup in tuple(lightgroups):
+        if lightgroup.name.startswith(("EMP_ShadingPass", "EMP_ShadowPass")) and lightgroup.name not in keep:
+            lightgroups.remove(lightgroup)
+
+
+def init_shading_scene(scene, light_directions):
+    render = scene.render
+    render.engine = 'CYCLES'
+
+    view_layer = scene.view_layers[0]
+    clear_passes(render, view_layer)
+
+    add_shading_lights(scene, view_layer, light_directions)
+
+    blank_material = bpy.data.materials.get("EMP_BlankMaterial") or create_blank_material("EMP_BlankMaterial")
     view_layer.material_override = blank_material
 
     set_standard_view_transform(scene)
@@ -489,33 +790,57 @@ def init_shading_scene(scene):
     depsgraph.update()
 
 
-def init_cryptomatte_scene(scene):
+def init_cryptomatte_scene(scene, passes):
     render = scene.render
     view_layer = scene.view_layers[0]
 
-    object_masks = tuple(get_mask_layers(selection_type="OBJECT"))
-    material_masks = tuple(get_mask_layers(selection_type="MATERIAL"))
-    collection_masks = tuple(get_mask_layers(selection_type="COLLECTION"))
-    
     clear_passes(render, view_layer)
 
-    if len((*object_masks, *collection_masks)) > 0:
-        view_layer.use_pass_cryptomatte_object = True
-
-    if len(material_masks) > 0:
-        view_layer.use_pass_cryptomatte_material = True
+    for pass_name in passes:
+        setattr(view_layer, pass_name_map[pass_name], True)
 
     set_standard_view_transform(scene)
     apply_mask_scene_settings(scene)
 
 
+def assign_pass_indices(assignments):
+    # The original index is kept in a custom property until it is restored,
+    # so it survives a crash or a save in the middle of an export
+    data_collections = {"OBJECT" : bpy.data.objects, "MATERIAL" : bpy.data.materials}
+
+    for id_type, name, index in assignments:
+        id_data = data_collections[id_type].get(name)
+        if id_data is None or id_data.library is not None:
+            continue
+
+        if "emp_pass_index" not in id_data:
+            id_data["emp_pass_index"] = id_data.pass_index
+        id_data.pass_index = index
+        ignore_update(id_data)
+
+
+def restore_pass_indices():
+    for data_collection in (bpy.data.objects, bpy.data.materials):
+        for id_data in data_collection:
+            if "emp_pass_index" in id_data:
+                id_data.pass_index = id_data["emp_pass_index"]
+                del id_data["emp_pass_index"]
+                ignore_update(id_data)
+
+
 def init_solo_scene(scene):
     render = scene.render
     view_layer = scene.view_layers[0]
     active_camera = bpy.context.scene.camera
     
     clear_passes(render, view_layer)
-    scene.collection.objects.link(active_camera)
+
+    for obj in tuple(scene.collection.objects):
+        if obj != active_camera:
+            scene.collection.objects.unlink(obj)
+
+    if active_camera.name not in scene.collection.objects:
+        scene.collection.objects.link(active_camera)
     scene.camera = active_camera
 
     scene.render.film_transparent = True
@@ -524,6 +849,10 @@ def init_solo_scene(scene):
     active_scene = bpy.context.scene
     scene.cycles.feature_set = active_scene.cycles.feature_set
     scene.cycles.device = active_scene.cycles.device
+    scene.cycles.use_denoising = active_scene.cycles.use_denoising
+
+    for attr in ("resolution_x", "resolution_y", "resolution_percentage", "pixel_aspect_x", "pixel_aspect_y"):
+        setattr(scene.render, attr, getattr(active_scene.render, attr))
 
 
 def get_prop_name(data, prop_name):
@@ -0,0 +1,85 @@
+import bpy
+
+import os
+import subprocess
+
+from .render_cache import cache_directory, discard_stale_renders
+from .utils import prepare_file_render
+
+
+# Runs inside each background Blender instance,
+# which only receives the helper scenes that were written to a temporary file
+worker_script = """
+import bpy, sys
+
+scene_name, path = sys.argv[sys.argv.index("--") + 1:]
+scene = bpy.data.scenes[scene_name]
+
+bpy.ops.render.render(scene=scene.name)
+for img in bpy.data.images:
+    if img.type == 'RENDER_RESULT':
+        img.save_render(path, scene=scene)
+        break
+"""
+
+
+def worker_thread_count(threads, worker_count):
+    if threads > 0:
+        return threads
+
+    return max(1, (os.cpu_count() or 1) // worker_count)
+
+
+def write_helper_scenes(scenes, filepath):
+    use_compositing = {scene: scene.render.use_compositing for scene in scenes}
+
+    for scene in scenes:
+        prepare_file_render(scene)
+
+    bpy.data.libraries.write(filepath, set(scenes), path_remap='ABSOLUTE', fake_user=True)
+
+    for scene, value in use_compositing.items():
+        scene.render.use_compositing = value
+
+
+def start_worker(blend_path, scene_name, path, threads):
+    command = [
+        bpy.app.binary_path, "--background", blend_path,
+        "--threads", str(threads),
+        "--python-exit-code", "1",
+        "--python-expr", worker_script,
+        "--", scene_name, path,
+        ]
+
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+
+def start_parallel_renders(pending, threads=0):
+    if len(pending) == 0:
+        return []
+
+    directory = cache_directory()
+    os.makedirs(directory, exist_ok=True)
+
+    blend_path = os.path.join(directory, "EMP_Helper_Scenes.blend")
+    write_helper_scenes([bpy.data.scenes[spec.name] for spec, _ in pending], blend_path)
+
+    threads = worker_thread_count(threads, len(pending))
+    return [(spec, path, start_worker(blend_path, spec.name, path, threads)) for spec, path in pending]
+
+
+def finish_parallel_renders(workers):
+    failed = []
+
+    for spec, path, process in workers:
+        if process.wait() != 0 or not os.path.exists(path):
+            failed.append(spec.name)
+        else:
+            discard_stale_renders(spec.name, path)
+
+    if failed:
+        raise RuntimeError(f"Background render failed for {', '.join(failed)}")
+
+
+def render_scenes_in_parallel(pending, threads=0):
+    finish_parallel_renders(start_parallel_renders(pending, threads))